@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Benchmark parsing and grouping alias dumps in cheatsheet.py.
+
+Generates synthetic `alias` output of the requested sizes, with the quoting
+zsh uses (single quotes, '\\'' for embedded quotes, backslashes, $'...') and
+environment assignments and redirections before the command, then times
+cheatsheet.cheatsheet() on it and measures its peak memory with tracemalloc.
+Prints the results as JSON:
+
+    python3 benchmark.py --sizes 1000,10000,100000 > current.json
+    python3 benchmark.py --compare baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cheatsheet
+
+COMMANDS = ['git', 'docker', 'kubectl', 'ls', 'grep', 'cd', 'npm', 'ssh', 'vim', 'make', 'cargo', 'terraform']
+ARGUMENTS = ['status', 'push --force-with-lease', 'log --oneline --graph', '-lah', '--color=auto', 'run --rm -it']
+
+
+def quote(word):
+    # the way zsh prints words in `alias` output
+    if word and all(char.isalnum() or char in '-_./' for char in word):
+        return word
+    if '\n' in word:
+        return "$'%s'" % word.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n')
+    return "'%s'" % word.replace("'", "'\\''")
+
+
+def generate(size, seed=0):
+    """return the text of an alias dump with size aliases"""
+    rng = random.Random(seed)
+    # a long tail of commands with a single alias, like plugins with one shortcut
+    commands = COMMANDS + ['tool%d' % i for i in range(max(1, size // 20))]
+    lines = []
+    for i in range(size):
+        command = rng.choice(commands) if rng.random() < 0.5 else rng.choice(COMMANDS)
+        value = '%s %s' % (command, rng.choice(ARGUMENTS))
+        kind = rng.random()
+        if kind < 0.1:
+            value = 'LANG=C ' + value
+        elif kind < 0.15:
+            value = "%s --format='%%h %%s'" % value
+        elif kind < 0.17:
+            value = '2>/dev/null ' + value
+        elif kind < 0.18:
+            value = value + '\nclear'
+        lines.append('%s=%s\n' % (quote('a%d' % i if kind > 0.01 else 'a-%d?' % i), quote(value)))
+    return ''.join(lines)
+
+
+def measure(text, runs):
+    times = []
+    for _ in range(runs):
+        lines = io.StringIO(text)
+        start = time.perf_counter()
+        result = cheatsheet.cheatsheet(lines)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    tracemalloc.start()
+    result = cheatsheet.cheatsheet(io.StringIO(text))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'parse_ms': {'min': round(times[0] * 1000, 3), 'p50': round(times[len(times) // 2] * 1000, 3)},
+        'peak_kib': round(peak / 1024.0, 1),
+        'result_kib': round(current / 1024.0, 1),
+        'groups': len(result),
+    }
+
+
+def compare(results, baseline, threshold):
+    """return the sizes whose median parse time or peak memory grew past threshold times the baseline"""
+    before = dict((result['size'], result) for result in baseline.get('results', []))
+    regressions = []
+    for result in results:
+        old = before.get(result['size'])
+        if old is None:
+            continue
+        for name, new_value, old_value in (('parse_ms.p50', result['parse_ms']['p50'], old['parse_ms']['p50']),
+                                           ('peak_kib', result['peak_kib'], old['peak_kib'])):
+            if old_value and new_value > old_value * threshold:
+                regressions.append({'size': result['size'], 'metric': name, 'baseline': old_value, 'current': new_value})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing alias dumps.", prog="benchmark.py")
+    parser.add_argument('--sizes', default='1000,10000,100000', help="comma-separated numbers of aliases (default: %(default)s)")
+    parser.add_argument('--runs', type=int, default=10, help="timed runs per size (default: %(default)s)")
+    parser.add_argument('--compare', metavar='BASELINE', help="JSON output of a previous run to check for regressions")
+    parser.add_argument('--threshold', type=float, default=1.2, help="ratio over the baseline that counts as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = {'size': size}
+        result.update(measure(generate(size), args.runs))
+        results.append(result)
+        print('%d aliases: %.1f ms, %.0f KiB peak' % (size, result['parse_ms']['p50'], result['peak_kib']), file=sys.stderr)
+    report = {'python': platform.python_version(), 'results': results}
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = compare(results, json.load(f), args.threshold)
+        status = 1 if report['regressions'] else 0
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
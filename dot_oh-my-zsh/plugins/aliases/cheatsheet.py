@@ -1,69 +1,400 @@
 #!/usr/bin/env python3
 import sys
-import itertools
-import termcolor
-import argparse
+import os
+import hashlib
+import marshal
+
+# `alias` prints name=value, each side quoted the way zsh quotes words when
+# needed: in single quotes ('\'' for a quote), with backslashes, or as $'...'
+# with C escapes. Patterns are compiled on first use, answers from the cache
+# don't need the re module.
+_patterns = None
+
+def patterns():
+    global _patterns
+    if _patterns is None:
+        import re
+        word = r"(?:'[^']*'|\$'(?:[^'\\]|\\.)*'|\\.|[^'\\=\s])+"
+        _patterns = (
+            # plain name or quoted name, then value in single quotes, plain value or anything else
+            re.compile(r"\s*(?:([^'\\=\s$]+)|(%s))=(?:'([^']*)'|([^'\\$\s]*)|(.*?))\s*$" % word, re.S).match,
+            re.compile(r"'([^']*)'|\$'((?:[^'\\]|\\.)*)'|\\(.)|([^'\\$]+|\$)", re.S).findall,
+            # the command is the first word that isn't an assignment or a redirection
+            re.compile(r'(?<!\S)[^\s=<>]+(?!\S)').search,
+        )
+    return _patterns
+
+def unquote(word, pieces):
+    parts = []
+    for quoted, ansi, escaped, plain in pieces(word):
+        if ansi:
+            import codecs
+            ansi = codecs.escape_decode(ansi.replace('\\e', '\\x1b').encode('utf-8', 'surrogateescape'))[0]
+            parts.append(ansi.decode('utf-8', 'surrogateescape'))
+        else:
+            parts.append(quoted or escaped or plain)
+    return ''.join(parts)
+
+def parse_lines(lines):
+    # yield (name, value, command) for each line as it is read
+    match_alias, pieces, search_command = patterns()
+    intern = sys.intern
+    for line in lines:
+        match = match_alias(line)
+        if match is None:
+            left = right = line.strip()
+        else:
+            name, quoted_name, value, plain_value, quoted_value = match.groups()
+            left = name if name is not None else unquote(quoted_name, pieces)
+            right = value if value is not None else plain_value if plain_value is not None else unquote(quoted_value, pieces)
+        command = search_command(right)
+        yield (left, right, intern(command.group() if command else right))
 
 def parse(line):
-    left = line[0:line.find('=')].strip()
-    right = line[line.find('=')+1:].strip('\'"\n ')
-    try:
-        cmd = next(part for part in right.split() if len([char for char in '=<>' if char in part])==0)
-    except StopIteration:
-        cmd = right
-    return (left, right, cmd)
+    return next(parse_lines([line]))
 
 def cheatsheet(lines):
-    exps = [ parse(line) for line in lines ]
-    exps.sort(key=lambda exp:exp[2])
-    cheatsheet = {'_default': []}
-    for key, group in itertools.groupby(exps, lambda exp:exp[2]):
-        group_list = [ item for item in group ]
-        if len(group_list)==1:
-            target_aliases = cheatsheet['_default']
+    # group in one pass over the lines, aliases keep their order within a group
+    groups = {}
+    for exp in parse_lines(lines):
+        group = groups.get(exp[2])
+        if group is None:
+            groups[exp[2]] = [exp]
         else:
-            if key not in cheatsheet:
-                cheatsheet[key] = []
-            target_aliases = cheatsheet[key]
-        target_aliases.extend(group_list)
+            group.append(exp)
+    cheatsheet = {'_default': []}
+    # commands with a single alias go to _default, ordered by command
+    for key in sorted([key for key, group in groups.items() if len(group) == 1 or key == '_default']):
+        cheatsheet['_default'].extend(groups[key])
+    for key, group in groups.items():
+        if len(group) > 1 and key != '_default':
+            cheatsheet[key] = group
     return cheatsheet
 
-def pretty_print_group(key, aliases, highlight=None, only_groupname=False):
+# Query terms are merged into a trie, compiled to a single pattern: at each
+# position the regex engine follows one branch per character, so the cost of
+# highlighting doesn't grow with the number of terms. The match is the longest
+# term starting at the leftmost position, as with an alternation ordered by length.
+def trie_pattern(words):
+    import re
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+    def compile(node):
+        branches = [re.escape(char) + compile(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:%s)' % '|'.join(branches)
+        return '(?:%s)?' % pattern if '' in node else pattern
+    return compile(trie)
+
+def highlighter(words):
+    import re
+    words = set(word for word in words if word)
+    pattern = re.compile(trie_pattern(words))
+    replacements = {}
+    def highlight(text, color, mark):
+        if not words or not color.prefix and not mark.prefix:
+            return color(text)
+        marked = replacements.get((color, mark))
+        if marked is None:
+            # each match closes color, is marked, and opens color again
+            marked = replacements[(color, mark)] = dict((word, color.suffix + mark(word) + color.prefix) for word in words)
+        return color.prefix + pattern.sub(lambda match: marked[match.group()], text) + color.suffix
+    return highlight
+
+# how control characters, e.g. from $'...' values, are shown instead of acting on the terminal
+ESCAPES = {'\n': '\\n', '\t': '\\t', '\r': '\\r', '\x1b': '\\e'}
+
+def printable(text):
+    if text.isprintable():
+        return text
+    chars = []
+    for char in text:
+        code = ord(char)
+        if char.isprintable():
+            chars.append(char)
+        elif char in ESCAPES:
+            chars.append(ESCAPES[char])
+        elif code < 0x100:
+            chars.append('\\x%02x' % code)
+        else:
+            chars.append('\\u%04x' % code if code < 0x10000 else '\\U%08x' % code)
+    return ''.join(chars)
+
+def render_group(key, aliases, highlight=None, only_groupname=False):
+    import termcolor
     if len(aliases) == 0:
-        return
-    group_hl_formatter = lambda g, hl: termcolor.colored(hl, 'yellow').join([termcolor.colored(part, 'red') for part in ('[%s]' % g).split(hl)])
-    alias_hl_formatter = lambda alias, hl: termcolor.colored(hl, 'yellow').join([termcolor.colored(part, 'green') for part in ('\t%s = %s' % alias[0:2]).split(hl)])
-    group_formatter = lambda g: termcolor.colored('[%s]' % g, 'red')
-    alias_formatter = lambda alias: termcolor.colored('\t%s = %s' % alias[0:2], 'green')
-    if highlight and len(highlight)>0:
-        print (group_hl_formatter(key, highlight))
+        return []
+    red, green, yellow = termcolor.style('red'), termcolor.style('green'), termcolor.style('yellow')
+    if highlight:
+        lines = [highlight('[%s]' % printable(key), red, yellow)]
         if not only_groupname:
-            print ('\n'.join([alias_hl_formatter(alias, highlight) for alias in aliases]))
+            lines.extend([highlight('\t%s = %s' % (printable(alias[0]), printable(alias[1])), green, yellow)
+                          for alias in aliases])
     else:
-        print (group_formatter(key))
+        lines = [red('[%s]' % printable(key))]
         if not only_groupname:
-            print ('\n'.join([alias_formatter(alias) for alias in aliases]))
-    print ('')
+            lines.extend([green('\t%s = %s' % (printable(alias[0]), printable(alias[1]))) for alias in aliases])
+    lines.append('')
+    return lines
+
+def pretty_print_group(key, aliases, highlight=None, only_groupname=False):
+    import termcolor
+    termcolor.cprint_many(render_group(key, aliases, highlight, only_groupname))
+
+# Keyword search goes through an inverted index of the aliases: for each
+# trigram of their names and expansions, and for each word, the ids of the
+# aliases containing it. Ids number the aliases in the order they are printed.
+def build_index(cheatsheet):
+    import re
+    docs, names, expansions, grams, words = [], [], [], {}, {}
+    find_words = re.compile(r'\w+').findall
+    for key in sorted(cheatsheet.keys()):
+        for position, alias in enumerate(cheatsheet[key]):
+            doc = len(docs)
+            docs.append((key, position))
+            names.append(alias[0])
+            expansions.append(alias[1])
+            text = '%s\n%s' % alias[0:2]
+            for gram in set([text[i:i+3] for i in range(len(text) - 2)]):
+                if gram in grams:
+                    grams[gram].append(doc)
+                else:
+                    grams[gram] = [doc]
+            for word in set(find_words(text)):
+                if word in words:
+                    words[word].append(doc)
+                else:
+                    words[word] = [doc]
+    return {'docs': docs, 'names': names, 'expansions': expansions, 'grams': grams, 'words': words,
+            'vocabulary': sorted(words)}
+
+def parse_query(keywords):
+    # keywords must all match, OR separates alternatives
+    alternatives = [[]]
+    for keyword in keywords:
+        if keyword == 'OR':
+            alternatives.append([])
+        elif keyword:
+            alternatives[-1].append(keyword)
+    return [terms for terms in alternatives if terms]
+
+def is_prefix(term):
+    return len(term) > 1 and term.endswith('*')
 
-def pretty_print(cheatsheet, wfilter, group_list=None, groups_only=False):
-    sorted_key = sorted(cheatsheet.keys())
-    for key in sorted_key:
+def postings(index, term):
+    # ids of the aliases that may match term, None for all of them
+    if is_prefix(term):
+        import bisect
+        import re
+        vocabulary, prefix, found = index['vocabulary'], term[:-1], []
+        if not re.fullmatch(r'\w+', prefix):
+            return None  # the vocabulary only has \w+ words, e.g. git-* has to be checked on every alias
+        i = bisect.bisect_left(vocabulary, prefix)
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+            found.extend(index['words'][vocabulary[i]])
+            i += 1
+        return found
+    if len(term) >= 3:
+        return min([index['grams'].get(term[i:i+3], ()) for i in range(len(term) - 2)], key=len)
+    return None
+
+def matcher(term):
+    if is_prefix(term):
+        import re
+        search = re.compile(r'(?<!\w)' + re.escape(term[:-1])).search
+        return lambda name, expansion: search(name) or search(expansion)
+    return lambda name, expansion: term in name or term in expansion
+
+def score(name, words):
+    total = 0
+    for word in words:
+        total += 4 if name == word else 2 if word in name else 1
+    return total
+
+def search(index, keywords):
+    # ids of the matching aliases, best first: exact names, then matches in names, then in expansions
+    scores = {}
+    names, expansions = index['names'], index['expansions']
+    for terms in parse_query(keywords):
+        lists = [postings(index, term) for term in terms]
+        lists = sorted([found for found in lists if found is not None], key=len)
+        # intersect the most selective lists while that is cheaper than checking the aliases
+        candidates = set(lists[0]) if lists else range(len(names))
+        for found in lists[1:]:
+            if not candidates or len(found) > 8 * len(candidates):
+                break
+            candidates.intersection_update(found)
+        checks = [matcher(term) for term in terms]
+        words = [term[:-1] if is_prefix(term) else term for term in terms]
+        for doc in candidates:
+            name, expansion = names[doc], expansions[doc]
+            if all([check(name, expansion) for check in checks]):
+                scores[doc] = max(scores.get(doc, 0), score(name, words))
+    return sorted(scores, key=lambda doc: (-scores[doc], doc))
+
+def render(cheatsheet, keywords, group_list=None, groups_only=False, index=None):
+    lines = []
+    if not keywords:
+        for key in sorted(cheatsheet.keys()):
+            if group_list and key not in group_list:
+                continue
+            lines.extend(render_group(key, cheatsheet.get(key), None, groups_only))
+        return lines
+    if index is None:
+        index = build_index(cheatsheet)
+    # groups in the order of their best match
+    groups = {}
+    for doc in search(index, keywords):
+        key, position = index['docs'][doc]
+        groups.setdefault(key, []).append(cheatsheet[key][position])
+    terms = [term for terms in parse_query(keywords) for term in terms]
+    highlight = highlighter([term[:-1] if is_prefix(term) else term for term in terms])
+    for key, aliases in groups.items():
         if group_list and key not in group_list:
             continue
-        aliases = cheatsheet.get(key)
-        if not wfilter:
-            pretty_print_group(key, aliases, wfilter, groups_only)
-        else:
-            pretty_print_group(key, [ alias for alias in aliases if alias[0].find(wfilter)>-1 or alias[1].find(wfilter)>-1], wfilter)
+        lines.extend(render_group(key, aliases, highlight))
+    return lines
 
-if __name__ == '__main__':
+def pretty_print(cheatsheet, keywords, group_list=None, groups_only=False, index=None):
+    import termcolor
+    termcolor.cprint_many(render(cheatsheet, keywords, group_list, groups_only, index))
+
+# Everything `als` prints only depends on the alias dump, the arguments and
+# ANSI_COLORS_DISABLED, so results are kept in ALS_CACHE_DIR under the hash of
+# the dump: the grouped cheatsheet (<hash>.marshal) and its search index
+# (<hash>.index), reused by new arguments, and the output for each set of
+# arguments used so far (<hash>-<args>.out).
+CACHE_SIZE = 64
+# part of the hash, to be increased whenever the output for the same dump changes
+CACHE_VERSION = 3
+
+def cache_dir():
+    return os.environ.get('ALS_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'als')
+
+def cache_read(name):
+    try:
+        with open(os.path.join(cache_dir(), name), 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def cache_write(name, data):
+    directory = cache_dir()
+    path = os.path.join(directory, name)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in entries[:max(0, len(entries) - CACHE_SIZE)]:
+            os.unlink(entry.path)
+    except (IOError, OSError):
+        pass # the cache is only an optimization
+
+def cached(name, build):
+    data = cache_read(name)
+    if data is not None:
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            pass
+    result = build()
+    cache_write(name, marshal.dumps(result))
+    return result
+
+def parse_args(argv):
+    import argparse
     parser = argparse.ArgumentParser(description="Pretty print aliases.", prog="als")
-    parser.add_argument('filter', nargs="*", metavar="<keyword>", help="search aliases matching keywords")
+    parser.add_argument('filter', nargs="*", metavar="<keyword>",
+                        help="search aliases matching all keywords, OR separates alternatives, end a keyword with * to match word prefixes")
     parser.add_argument('-g', '--group', dest="group_list", action='append', help="only print aliases in given groups")
     parser.add_argument('--groups', dest='groups_only', action='store_true', help="only print alias groups")
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
+def output(digest, lines, args, loaded=None):
+    # what als prints for args, as a string; loaded keeps the cheatsheet and index between calls
+    loaded = {} if loaded is None else loaded
+    if loaded.get('digest') != digest:
+        loaded.clear()
+        loaded['digest'] = digest
+    if 'aliases' not in loaded:
+        loaded['aliases'] = cached('%s.marshal' % digest, lambda: cheatsheet(lines))
+    if args.filter and 'index' not in loaded:
+        loaded['index'] = cached('%s.index' % digest, lambda: build_index(loaded['aliases']))
+    import termcolor
+    return termcolor.render(render(loaded['aliases'], args.filter, args.group_list or None, args.groups_only, loaded.get('index')))
+
+# With --serve, requests come in on stdin, one per line, for the zsh plugin
+# to keep a single process for the session (ALS_COPROC):
+#   dump <n>             followed by the n lines of `alias`, used by the next queries
+#   query <colors> <n>   followed by n arguments of als, one per line; colors is 0 or 1
+# Each request is answered with its exit status on one line, then the output
+# and the errors, each terminated by a NUL byte.
+def serve(stdin, stdout):
+    import contextlib
+    import io
+    read = lambda: stdin.readline().decode('utf-8', 'surrogateescape')
+    dump, digest, loaded = [], None, {}
+    while True:
+        request = read().split()
+        if not request:
+            return 0
+        status, out, err = 0, io.StringIO(), io.StringIO()
+        if request[0] == 'dump' and len(request) == 2:
+            dump = [read() for i in range(int(request[1]))]
+            digest = hashlib.sha1(b'%d\0' % CACHE_VERSION + ''.join(dump).encode('utf-8', 'surrogateescape')).hexdigest()
+        elif request[0] == 'query' and len(request) == 3:
+            # read the arguments even when failing, or they'd be taken for the next requests
+            argv = [read().rstrip('\n') for i in range(int(request[2]))]
+            if digest is None:
+                status = 2
+                err.write('als: query before dump\n')
+            else:
+                if request[1] == '1':
+                    os.environ.pop('ANSI_COLORS_DISABLED', None)
+                else:
+                    os.environ['ANSI_COLORS_DISABLED'] = '1'
+                try:
+                    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                        args = parse_args(argv)
+                        out.write(output(digest, dump, args, loaded))
+                except SystemExit as e:
+                    # --help and usage errors
+                    status = e.code if isinstance(e.code, int) else 1
+        else:
+            status = 2
+            err.write('als: unknown request %s\n' % request[0])
+        stdout.write(('%d\n%s\0%s\0' % (status, out.getvalue(), err.getvalue())).encode('utf-8', 'surrogateescape'))
+        stdout.flush()
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--serve']:
+        sys.exit(serve(sys.stdin.buffer, sys.stdout.buffer))
+
+    # the dump is read whole rather than streamed into the parser: its hash names the
+    # cached output, which has to be known before deciding whether to parse at all
+    dump = sys.stdin.buffer.read()
+    digest = hashlib.sha1(b'%d\0' % CACHE_VERSION + dump).hexdigest()
+    options = '\0'.join(sys.argv[1:] + [str(os.getenv('ANSI_COLORS_DISABLED') is None)])
+    output_name = '%s-%s.out' % (digest, hashlib.sha1(options.encode('utf-8', 'surrogateescape')).hexdigest()[:16])
+    cached_output = cache_read(output_name)
+    if cached_output is not None:
+        sys.stdout.buffer.write(cached_output)
+        sys.exit(0)
 
-    lines = sys.stdin.readlines()
-    group_list = args.group_list or None
-    wfilter = " ".join(args.filter) or None
-    pretty_print(cheatsheet(lines), wfilter, group_list, args.groups_only)
+    import io
+    args = parse_args(sys.argv[1:])
+    lines = io.TextIOWrapper(io.BytesIO(dump), encoding=sys.stdin.encoding, errors=sys.stdin.errors).readlines()
+    text = output(digest, lines, args)
+    data = text.encode(sys.stdout.encoding or 'utf-8', sys.stdout.errors or 'strict')
+    sys.stdout.buffer.write(data)
+    cache_write(output_name, data)
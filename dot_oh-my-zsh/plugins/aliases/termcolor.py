@@ -25,9 +25,10 @@
 
 from __future__ import print_function
 import os
+import sys
 
 
-__ALL__ = [ 'colored', 'cprint' ]
+__ALL__ = [ 'colored', 'cprint', 'style', 'render', 'cprint_many' ]
 
 VERSION = (1, 1, 0)
 
@@ -99,20 +100,51 @@ def colored(text, color=None, on_color=None, attrs=None):
         colored('Hello, World!', 'red', 'on_grey', ['blue', 'blink'])
         colored('Hello, World!', 'green')
     """
-    if os.getenv('ANSI_COLORS_DISABLED') is None:
-        fmt_str = '\033[%dm%s'
-        if color is not None:
-            text = fmt_str % (COLORS[color], text)
+    return style(color, on_color, attrs)(text)
 
-        if on_color is not None:
-            text = fmt_str % (HIGHLIGHTS[on_color], text)
 
-        if attrs is not None:
-            for attr in attrs:
-                text = fmt_str % (ATTRIBUTES[attr], text)
+class Style(object):
+    """Compiled arguments of colored(): the escape sequences to put around text."""
 
-        text += RESET
-    return text
+    __slots__ = ('prefix', 'suffix')
+
+    def __init__(self, prefix='', suffix=''):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def __call__(self, text):
+        return self.prefix + text + self.suffix
+
+
+_styles = {}
+
+
+def style(color=None, on_color=None, attrs=None):
+    """Return the Style colorizing text like colored() with the same arguments.
+
+    The escape sequences are resolved once per combination of arguments and
+    ANSI_COLORS_DISABLED, and the result cached:
+
+        red = style('red', attrs=['bold'])
+        print(red('Hello') + ', ' + red('World!'))
+    """
+    key = (color, on_color, tuple(attrs) if attrs is not None else None, os.getenv('ANSI_COLORS_DISABLED') is None)
+    compiled = _styles.get(key)
+    if compiled is None:
+        if key[3]:
+            prefix = ''
+            if color is not None:
+                prefix = '\033[%dm' % COLORS[color]
+            if on_color is not None:
+                prefix = '\033[%dm' % HIGHLIGHTS[on_color] + prefix
+            if attrs is not None:
+                for attr in attrs:
+                    prefix = '\033[%dm' % ATTRIBUTES[attr] + prefix
+            compiled = Style(prefix, RESET)
+        else:
+            compiled = Style()
+        _styles[key] = compiled
+    return compiled
 
 
 def cprint(text, color=None, on_color=None, attrs=None, **kwargs):
@@ -124,6 +156,36 @@ def cprint(text, color=None, on_color=None, attrs=None, **kwargs):
     print((colored(text, color, on_color, attrs)), **kwargs)
 
 
+def render(items, end='\n'):
+    """Return many lines as one string.
+
+    Items are either strings, taken as they are, or (text, color, on_color,
+    attrs) tuples, trailing arguments optional, colorized like colored().
+    """
+    parts = []
+    for item in items:
+        if isinstance(item, tuple):
+            item = style(*item[1:])(item[0])
+        parts.append(item)
+        parts.append(end)
+    return ''.join(parts)
+
+
+def cprint_many(items, end='\n', file=None):
+    """Print many lines, see render(), with a single write to file."""
+    if file is None:
+        file = sys.stdout
+    text = render(items, end)
+    buffer = getattr(file, 'buffer', None)
+    if buffer is None:
+        file.write(text)
+        file.flush()
+        return
+    file.flush()
+    buffer.write(text.encode(file.encoding or 'utf-8', file.errors or 'strict'))
+    buffer.flush()
+
+
 if __name__ == '__main__':
     print('Current terminal type: %s' % os.getenv('TERM'))
     print('Test basic colors:')
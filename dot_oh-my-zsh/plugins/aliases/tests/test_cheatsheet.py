@@ -0,0 +1,40 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cheatsheet
+
+
+class RenderTest(unittest.TestCase):
+    """$'...' values are shown escaped, one line per alias, without acting on the terminal"""
+
+    def setUp(self):
+        self.colors = os.environ.get('ANSI_COLORS_DISABLED')
+        os.environ['ANSI_COLORS_DISABLED'] = '1'
+
+    def tearDown(self):
+        if self.colors is None:
+            os.environ.pop('ANSI_COLORS_DISABLED', None)
+        else:
+            os.environ['ANSI_COLORS_DISABLED'] = self.colors
+
+    def render(self, dump, keywords=None):
+        return cheatsheet.render(cheatsheet.cheatsheet(dump.splitlines(True)), keywords)
+
+    def test_control_characters(self):
+        lines = self.render("x=$'echo a\\nclear'\ny=$'\\e[31mred'\nz='echo ok'\n")
+        self.assertEqual(lines, ['[_default]', '\ty = \\e[31mred', '',
+                                 '[echo]', '\tx = echo a\\nclear', '\tz = echo ok', ''])
+
+    def test_control_characters_in_search(self):
+        lines = self.render("y=$'\\e[31mred'\n", ['red'])
+        self.assertEqual(lines, ['[_default]', '\ty = \\e[31mred', ''])
+
+    def test_values_are_unquoted(self):
+        self.assertEqual(cheatsheet.parse("x=$'echo a\\nclear'\n")[1], 'echo a\nclear')
+        self.assertEqual(cheatsheet.printable('tab\there\x07'), 'tab\\there\\x07')
+
+
+if __name__ == '__main__':
+    unittest.main()
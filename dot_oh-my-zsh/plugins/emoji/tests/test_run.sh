@@ -0,0 +1,63 @@
+#!/usr/bin/env zunit
+
+@setup {
+  load ../emoji.plugin.zsh
+
+  # report what _omz_emoji_load_for asks for instead of loading it
+  stub_load() {
+    function _omz_emoji_load() {
+      print -r -- "$*"
+    }
+  }
+}
+
+@test 'load everything by default' {
+  assert "${emoji[rocket]}" is_not_empty
+  assert "${emoji_flags[Germany]}" is_not_empty
+  assert "${emoji_groups[fruits]}" is_not_empty
+  assert "${#_omz_emoji_shards}" equals 0
+}
+
+@test 'find the map a command line refers to' {
+  stub_load
+
+  run _omz_emoji_load_for 'echo $emoji[rocket]'
+
+  assert $state equals 0
+  assert "$output" same_as "emoji"
+}
+
+@test 'find every map and group in order' {
+  stub_load
+
+  run _omz_emoji_load_for 'print $emoji_groups[fruits] ${emoji_flags[Germany]} $emoji_mod'
+
+  assert $state equals 0
+  assert "$output" same_as "emoji_groups:fruits emoji_flags emoji_mod"
+}
+
+@test 'find maps right next to each other' {
+  stub_load
+
+  run _omz_emoji_load_for 'echo ${emoji_mod}$emoji$emoji_groups'
+
+  assert $state equals 0
+  assert "$output" same_as "emoji_mod emoji emoji_groups"
+}
+
+@test 'find maps after multibyte characters' {
+  stub_load
+
+  run _omz_emoji_load_for 'echo 🚀🚀 $emoji[rocket] é $emoji_flags'
+
+  assert $state equals 0
+  assert "$output" same_as "emoji emoji_flags"
+}
+
+@test 'ignore words that only contain emoji' {
+  stub_load
+
+  run _omz_emoji_load_for 'echo myemoji emoji_thing $emojis'
+
+  assert "$output" is_empty
+}
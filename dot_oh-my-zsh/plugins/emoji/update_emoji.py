@@ -3,16 +3,24 @@ Update Emoji.py
 Refreshes OMZ emoji database based on the latest Unicode spec
 """
 import re
+import sys
 import json
+from collections import namedtuple
 
-spec = open("emoji-data.txt", "r")
-
-# Regexes
+# Regexes, compiled once as the spec is read line by line
 # regex_emoji will return, respectively:
 # the code points, its type (status), the actual emoji, and its official name
-regex_emoji = r"^([\w ].*?\S)\s*;\s*([\w-]+)\s*#\s*(.*?)\s(\S.*).*$"
+regex_emoji = re.compile(r"^([\w ].*?\S)\s*;\s*([\w-]+)\s*#\s*(.*?)\s(\S.*).*$").match
 # regex_group returns the group of subgroup that a line opens
-regex_group = r"^#\s*(group|subgroup):\s*(.*)$"
+regex_group = re.compile(r"^#\s*(group|subgroup):\s*(.*)$").match
+# regex_non_word matches what snake_case() turns into underscores
+regex_non_word = re.compile(r'[^\#\*\w]')
+# regex_plain_word matches the names zsh_word() doesn't need to quote
+regex_plain_word = re.compile(r'[A-Za-z0-9_]+$').match
+
+# One emoji of the spec: its ZSH-compatible code points, status, character,
+# unique short name, group and subgroup
+Emoji = namedtuple('Emoji', ['codes', 'status', 'emoji', 'name', 'group', 'subgroup'])
 
 headers = """
 # emoji-char-definitions.zsh - Emoji definitions for oh-my-zsh emoji plugin
@@ -41,31 +49,74 @@ typeset -gAH emoji_groups
 """
 
 #######
-# Adding country codes
+# Alias sources
 #######
-# This is the only part of this script that relies on an external library
-# (country_converter), and is hence commented out by default.
-# You can uncomment it to have country codes added as aliases for flag
-# emojis. (By default, when you install this extension, country codes are
-# included as aliases, but not if you re-run this script without uncommenting.)
-# Warning: country_converter is very verbose, and will print warnings all over
-# your terminal.
-
-# import country_converter as coco # pylint: disable=wrong-import-position
-# cc = coco.CountryConverter()
-
-# def country_iso(_all_names, _omz_name):
-#     """ Using the external library country_converter,
-#         this function can detect the ISO2 and ISO3 codes
-#         of the country. It takes as argument the array
-#         with all the names of the emoji, and returns that array."""
-#     omz_no_underscore = re.sub(r'_', r' ', _omz_name)
-#     iso2 = cc.convert(names=[omz_no_underscore], to='ISO2')
-#     if iso2 != 'not found':
-#         _all_names.append(iso2)
-#         iso3 = cc.convert(names=[omz_no_underscore], to='ISO3')
-#         _all_names.append(iso3)
-#     return _all_names
+# Besides its name from the spec, an emoji can be given aliases by any number
+# of sources, joined with the spec by resolve_aliases(). A source has a name,
+# used in conflict reports, and returns the aliases of one Emoji record.
+
+class AliasSource:
+    """ Base class of the sources of aliases """
+    name = "aliases"
+
+    def aliases(self, _emoji_data):
+        """ Returns the aliases of an Emoji record """
+        return ()
+
+class GemojiAliases(AliasSource):
+    """ Aliases from the DB of Gemoji
+    Retrieved on Aug 9 2019 from the following URL:
+    https://raw.githubusercontent.com/github/gemoji/master/db/emoji.json """
+    name = "gemoji"
+
+    def __init__(self, _path="gemoji_db.json"):
+        with open(_path) as gemoji_db:
+            self.aliases_map = {entry['emoji']: entry['aliases'] for entry in json.load(gemoji_db)}
+
+    def aliases(self, _emoji_data):
+        return self.aliases_map.get(_emoji_data.emoji, ())
+
+class CldrAliases(AliasSource):
+    """ CLDR short names, from an annotations file such as
+    https://github.com/unicode-org/cldr/blob/main/common/annotations/en.xml
+    CLDR leaves out the variation selectors, so only fully-qualified
+    emojis get these. """
+    name = "cldr"
+
+    def __init__(self, _path):
+        from xml.etree import ElementTree
+        self.aliases_map = {}
+        for annotation in ElementTree.parse(_path).iter("annotation"):
+            if annotation.get("type") == "tts" and annotation.text:
+                self.aliases_map[annotation.get("cp")] = [snake_case(annotation.text)]
+
+    def aliases(self, _emoji_data):
+        if _emoji_data.status != "fully-qualified":
+            return ()
+        return self.aliases_map.get(_emoji_data.emoji.replace("\uFE0F", ""), ())
+
+class CountryCodes(AliasSource):
+    """ ISO2 and ISO3 country codes of flags
+    This is the only source that relies on an external library
+    (country_converter), and is hence only used with --country-codes.
+    (By default, when you install this extension, country codes are
+    included as aliases, but not if you re-run this script without it.)
+    Warning: country_converter is very verbose, and will print warnings all over
+    your terminal. """
+    name = "country codes"
+
+    def __init__(self):
+        import country_converter as coco
+        self.converter = coco.CountryConverter()
+
+    def aliases(self, _emoji_data):
+        if _emoji_data.group != "Flags":
+            return ()
+        omz_no_underscore = _emoji_data.name.replace('_', ' ')
+        iso2 = self.converter.convert(names=[omz_no_underscore], to='ISO2')
+        if iso2 == 'not found':
+            return ()
+        return [iso2, self.converter.convert(names=[omz_no_underscore], to='ISO3')]
 
 
 #######
@@ -76,15 +127,15 @@ def code_to_omz(_code_points):
     """ Returns a ZSH-compatible Unicode string from the code point(s) """
     return r'\U' + r'\U'.join(_code_points.split(' '))
 
+def snake_case(_string):
+    """ Does the regex work of snake_case """
+    remove_dots = _string.replace('.()', '')
+    replace_ands = remove_dots.replace('&', 'and')
+    remove_whitespace = regex_non_word.sub('_', replace_ands)
+    return remove_whitespace.replace('__', '_')
+
 def name_to_omz(_name, _group, _subgroup, _status):
     """ Returns a reasonable snake_case name for the emoji. """
-    def snake_case(_string):
-        """ Does the regex work of snake_case """
-        remove_dots = re.sub(r'\.\(\)', r'', _string)
-        replace_ands = re.sub(r'\&', r'and', remove_dots)
-        remove_whitespace = re.sub(r'[^\#\*\w]', r'_', replace_ands)
-        return re.sub(r'__', r'_', remove_whitespace)
-
     shortname = ""
     split_at_colon = lambda s: s.split(": ")
     # Special treatment by group and subgroup
@@ -103,111 +154,203 @@ def name_to_omz(_name, _group, _subgroup, _status):
         shortname += "_minimally"
     return shortname
 
-def increment_name(_shortname):
-    """ Increment the short name by 1. If you get, say,
-    'woman_detective_unqualified', it returns
-    'woman_detective_unqualified_1', and then
-    'woman_detective_unqualified_2', etc. """
-    last_char = _shortname[-1]
-    if last_char.isdigit():
-        num = int(last_char)
-        return _shortname[:-1] + str(num + 1)
-    return _shortname + "_1"
+def unique_name(_shortname, _seen):
+    """ Returns _shortname the first time it is asked for, then
+    '_shortname_1', '_shortname_2', etc., skipping names already taken.
+    _seen maps every name given out so far to the next number
+    to try for it. """
+    count = _seen.get(_shortname)
+    if count is None:
+        _seen[_shortname] = 1
+        return _shortname
+    name = f"{_shortname}_{count}"
+    while name in _seen:
+        count += 1
+        name = f"{_shortname}_{count}"
+    _seen[_shortname] = count + 1
+    _seen[name] = 1
+    return name
+
+def parse_spec(_lines):
+    """ Yields an Emoji for every emoji line of the spec (emoji-test.txt),
+    reading it one line at a time. """
+    group, subgroup, seen = "", "", {}
+    for line in _lines:
+        # Comments can only open a group or subgroup
+        if line.startswith("#"):
+            group_match = regex_group(line)
+            if group_match is not None:
+                gr_or_sub, name = group_match.groups()
+                if gr_or_sub == "group":
+                    group = sys.intern(name)
+                else:
+                    subgroup = sys.intern(name)
+            continue
+        emoji_match = regex_emoji(line)
+        if emoji_match is not None:
+            code_points, status, emoji, name = emoji_match.groups()
+            omz_name = unique_name(name_to_omz(name, group, subgroup, status), seen)
+            yield Emoji(code_to_omz(code_points), sys.intern(status), emoji, omz_name, group, subgroup)
 
 ########
-# Going through every line
+# Join the aliases
 ########
 
-group, subgroup, short_name_buffer = "", "", ""
-emoji_database = []
-for line in spec:
-    # First, test if this line opens a group or subgroup
-    group_match = re.findall(regex_group, line)
-    if group_match != []:
-        gr_or_sub, name = group_match[0]
-        if gr_or_sub == "group":
-            group = name
-        elif gr_or_sub == "subgroup":
-            subgroup = name
-        continue # Moving on...
-    # Second, test if this line references one emoji
-    emoji_match = re.findall(regex_emoji, line)
-    if emoji_match != []:
-        code_points, status, emoji, name = emoji_match[0]
-        omz_codes = code_to_omz(code_points)
-        omz_name = name_to_omz(name, group, subgroup, status)
-        # If this emoji has the same shortname as the preceding one
-        if omz_name in short_name_buffer:
-            omz_name = increment_name(short_name_buffer)
-        short_name_buffer = omz_name
-        emoji_database.append(
-            [omz_codes, status, emoji, omz_name, group, subgroup])
-spec.close()
+def resolve_aliases(emoji_database, sources, conflicts=None):
+    """ Yields (Emoji, names) for every Emoji record in emoji_database, names
+    being its own name followed by its aliases from each of the sources.
+    Names from the spec always win. Otherwise the first emoji to claim an
+    alias keeps it, in the order of the spec and then of the sources. An
+    alias claimed for another emoji is left out and, if conflicts is a
+    list, recorded there as (alias, source name, emoji name, owner name). """
+    taken = {emoji_data.name: emoji_data for emoji_data in emoji_database}
+    for emoji_data in emoji_database:
+        names = [emoji_data.name]
+        for source in sources:
+            for alias in source.aliases(emoji_data):
+                owner = taken.setdefault(alias, emoji_data)
+                if owner is not emoji_data:
+                    if conflicts is not None and owner.codes != emoji_data.codes:
+                        conflicts.append((alias, source.name, emoji_data.name, owner.name))
+                elif alias not in names:
+                    names.append(alias)
+        yield emoji_data, names
 
 ########
 # Write to emoji-char-definitions.zsh
 ########
 
-# Aliases for emojis are retrieved through the DB of Gemoji
-# Retrieved on Aug 9 2019 from the following URL:
-# https://raw.githubusercontent.com/github/gemoji/master/db/emoji.json
+GROUP_NAMES = ["fruits", "vehicles", "hands", "people", "animals", "faces", "flags"]
+
+def map_of(_status, _group):
+    """ Returns the variable that indicates in which map the emoji will be located """
+    if _group == "Flags":
+        return "emoji_flags"
+    if _status == "component":
+        return "emoji_mod"
+    return "emoji"
 
-gemoji_db = open("gemoji_db.json")
-j = json.load(gemoji_db)
-aliases_map = {entry['emoji']: entry['aliases'] for entry in j}
-all_omz_names = [emoji_data[3] for emoji_data in emoji_database]
+def group_of(_status, _group, _subgroup):
+    """ Returns the emoji_groups entry the emoji is listed in, if any """
+    if _status == "fully-qualified":
+        if _subgroup == "food-fruit":
+            return "fruits"
+        if "transport-" in _subgroup:
+            return "vehicles"
+        if "hand-" in _subgroup:
+            return "hands"
+        if "person-" in _subgroup or _subgroup == "family":
+            return "people"
+        if "animal-" in _subgroup:
+            return "animals"
+        if "face-" in _subgroup:
+            return "faces"
+        if _group == "Flags":
+            return "flags"
+    return None
 
-# Let's begin writing to this file
-output = open("emoji-char-definitions.zsh", "w")
-output.write(headers)
+def write_definitions(resolved, output):
+    """ Writes the zsh definitions of the (Emoji, names) pairs of resolved to output. """
+    output.write(headers)
 
-emoji_groups = {"fruits": "\n", "vehicles": "\n", "hands": "\n",
-                "people": "\n", "animals": "\n", "faces": "\n",
-                "flags": "\n"}
+    emoji_groups = {name: [] for name in GROUP_NAMES}
 
-# First, write every emoji down
-for _omz_codes, _status, _emoji, _omz_name, _group, _subgroup in emoji_database:
+    # First, write every emoji down
+    for (_omz_codes, _status, _emoji, _omz_name, _group, _subgroup), names_for_this_emoji in resolved:
+        emoji_map = map_of(_status, _group)
+        for one_name in names_for_this_emoji:
+            output.write(f"{emoji_map}[{one_name}]=$'{_omz_codes}'\n")
 
-    # One emoji can be mapped to multiple names (aliases or country codes)
-    names_for_this_emoji = [_omz_name]
+        # Storing the emoji in defined subgroups for the next step
+        group_name = group_of(_status, _group, _subgroup)
+        if group_name is not None:
+            emoji_groups[group_name].append(_omz_name)
 
-    # Variable that indicates in which map the emoji will be located
-    emoji_map = "emoji"
-    if _status == "component":
-        emoji_map = "emoji_mod"
-    if _group == "Flags":
-        emoji_map = "emoji_flags"
-        # Adding country codes (Optional, see above)
-        # names_for_this_emoji = country_iso(names_for_this_emoji, _omz_name)
+    # Second, write the subgroups to the end of the file
+    for name, names in emoji_groups.items():
+        string = "".join(f"  {one_name}\n" for one_name in names)
+        output.write(f'\nemoji_groups[{name}]="\n{string}"\n')
 
-    # Check if there is an alias available in the Gemoji DB
-    if _emoji in aliases_map.keys():
-        for alias in aliases_map[_emoji]:
-            if alias not in all_omz_names:
-                names_for_this_emoji.append(alias)
+########
+# Write sharded definitions
+########
+# With --shards, the definitions are written to a directory instead: one file
+# per map and one per emoji_groups entry, each a single array assignment that
+# zsh parses (or zcompiles) in one go, and index.zsh, the only file
+# emoji.plugin.zsh sources at startup. It declares the maps and tells which
+# file fills each of them; the plugin sources a file once its map is used.
 
-    # And now we write to the definitions file
-    for one_name in names_for_this_emoji:
-        output.write(f"{emoji_map}[{one_name}]=$'{_omz_codes}'\n")
+def zsh_word(_string):
+    """ Returns _string as one zsh word, quoted unless it is plain """
+    if regex_plain_word(_string):
+        return _string
+    return "'" + _string.replace("'", "'\\''") + "'"
 
-    # Storing the emoji in defined subgroups for the next step
-    if _status == "fully-qualified":
-        if _subgroup == "food-fruit":
-            emoji_groups["fruits"] += f"  {_omz_name}\n"
-        elif "transport-" in _subgroup:
-            emoji_groups["vehicles"] += f"  {_omz_name}\n"
-        elif "hand-" in _subgroup:
-            emoji_groups["hands"] += f"  {_omz_name}\n"
-        elif "person-" in _subgroup or _subgroup == "family":
-            emoji_groups["people"] += f"  {_omz_name}\n"
-        elif "animal-" in _subgroup:
-            emoji_groups["animals"] += f"  {_omz_name}\n"
-        elif "face-" in _subgroup:
-            emoji_groups["faces"] += f"  {_omz_name}\n"
-        elif _group == "Flags":
-            emoji_groups["flags"] += f"  {_omz_name}\n"
-
-# Second, write the subgroups to the end of the file
-for name, string in emoji_groups.items():
-    output.write(f'\nemoji_groups[{name}]="{string}"\n')
-output.close()
+def write_shards(resolved, directory):
+    """ Writes the definitions of the (Emoji, names) pairs of resolved as
+    shards in directory, see above. """
+    import os
+    maps = {"emoji": [], "emoji_flags": [], "emoji_mod": []}
+    emoji_groups = {name: [] for name in GROUP_NAMES}
+    for (_omz_codes, _status, _emoji, _omz_name, _group, _subgroup), names_for_this_emoji in resolved:
+        entries = maps[map_of(_status, _group)]
+        for one_name in names_for_this_emoji:
+            entries.append(f"  {zsh_word(one_name)} $'{_omz_codes}'\n")
+        group_name = group_of(_status, _group, _subgroup)
+        if group_name is not None:
+            emoji_groups[group_name].append(_omz_name)
+
+    shards = {}
+    os.makedirs(os.path.join(directory, "groups"), exist_ok=True)
+    for emoji_map, entries in maps.items():
+        shards[emoji_map] = f"{emoji_map}.zsh"
+        with open(os.path.join(directory, shards[emoji_map]), "w") as output:
+            output.write(f"# ${emoji_map} shard, auto-generated by update_emoji.py. Do not edit it manually.\n")
+            output.write(f"{emoji_map}+=(\n{''.join(entries)})\n")
+    for name, names in emoji_groups.items():
+        shards[f"emoji_groups:{name}"] = f"groups/{name}.zsh"
+        with open(os.path.join(directory, shards[f"emoji_groups:{name}"]), "w") as output:
+            string = "".join(f"  {one_name}\n" for one_name in names)
+            output.write(f"# $emoji_groups[{name}] shard, auto-generated by update_emoji.py. Do not edit it manually.\n")
+            output.write(f'emoji_groups[{name}]="\n{string}"\n')
+
+    with open(os.path.join(directory, "index.zsh"), "w") as output:
+        output.write(headers.replace("emoji-char-definitions.zsh - Emoji definitions",
+                                     "index.zsh - Index of the sharded emoji definitions"))
+        output.write("\n# The file defining each map, or each group as emoji_groups:<group>\n")
+        output.write("typeset -gAH _omz_emoji_shards\n_omz_emoji_shards=(\n")
+        output.write("".join(f"  {key} {path}\n" for key, path in shards.items()))
+        output.write(")\n")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Refreshes OMZ emoji database based on the latest Unicode spec")
+    parser.add_argument("--cldr", metavar="FILE", action="append", default=[],
+                        help="add the short names of a CLDR annotations file as aliases")
+    parser.add_argument("--country-codes", action="store_true",
+                        help="add country codes as aliases of flags (needs country_converter)")
+    parser.add_argument("--shards", metavar="DIR",
+                        help="write the definitions to DIR as files the plugin loads on demand")
+    args = parser.parse_args()
+
+    sources = [GemojiAliases()]
+    sources.extend(CldrAliases(path) for path in args.cldr)
+    if args.country_codes:
+        try:
+            sources.append(CountryCodes())
+        except ImportError:
+            parser.error("--country-codes needs country_converter (pip install country_converter)")
+
+    with open("emoji-data.txt", "r") as spec:
+        emoji_database = list(parse_spec(spec))
+    conflicts = []
+    if args.shards:
+        write_shards(resolve_aliases(emoji_database, sources, conflicts), args.shards)
+    else:
+        with open("emoji-char-definitions.zsh", "w") as output:
+            write_definitions(resolve_aliases(emoji_database, sources, conflicts), output)
+    for alias, source, name, owner in conflicts:
+        print(f"{source} alias {alias} of {name} already names {owner}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Benchmark gitstatus.py on synthetic repositories.
+
+Generates local repositories of the requested sizes with given fractions of
+modified, staged, untracked and conflicted files plus a number of stash
+entries, on a branch, on a detached HEAD and on a tagged detached HEAD. Then
+times `python3 gitstatus.py` end to end and its phases in-process, and prints
+the p50/p95/p99 latencies and peak RSS as JSON:
+
+    python3 benchmark.py --sizes 1000,100000 --runs 30 > current.json
+    python3 benchmark.py --sizes 1000,100000 --compare baseline.json
+
+Generated repositories are kept in --workdir and reused by later runs, since
+creating the larger ones takes minutes.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import gitstatus
+
+CASES = ('branch', 'detached', 'tagged')
+
+
+def git(repo, *args, **kwargs):
+    kwargs.setdefault('stdout', subprocess.DEVNULL)
+    kwargs.setdefault('stderr', subprocess.DEVNULL)
+    return subprocess.run(('git',) + args, cwd=repo, **kwargs)
+
+
+def file_path(i):
+    # 100 files per directory, 100 directories per top-level directory
+    return os.path.join('d%03d' % (i // 10000), 'd%02d' % (i // 100 % 100), 'f%07d.txt' % i)
+
+
+def write(repo, path, content, mode='w'):
+    path = os.path.join(repo, path)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, mode) as f:
+        f.write(content)
+
+
+def generate(repo, size, case, args):
+    """create repo with size tracked files and the configured share of changes"""
+    os.makedirs(repo)
+    git(repo, 'init', '-q', '-b', 'main', check=True)
+    git(repo, 'config', 'user.name', 'bench')
+    git(repo, 'config', 'user.email', 'bench@example.com')
+    git(repo, 'config', 'commit.gpgsign', 'false')
+    for i in range(size):
+        write(repo, file_path(i), 'file %d\n' % i)
+    git(repo, 'add', '-A', check=True)
+    git(repo, 'commit', '-q', '-m', 'initial', check=True)
+
+    counts = dict((kind, int(size * getattr(args, kind))) for kind in ('modified', 'staged', 'untracked', 'conflicted'))
+    # disjoint ranges of files for each kind of change
+    conflicted = range(0, counts['conflicted'])
+    staged = range(conflicted.stop, conflicted.stop + counts['staged'])
+    modified = range(staged.stop, staged.stop + counts['modified'])
+
+    for n in range(args.stashes):
+        write(repo, file_path(size - 1), 'stash %d\n' % n, 'a')
+        git(repo, 'stash', '-q', check=True)
+
+    if case in ('detached', 'tagged'):
+        git(repo, 'checkout', '-q', '--detach', check=True)
+
+    if conflicted:
+        git(repo, 'branch', 'bench-other', 'HEAD', check=True)
+        for i in conflicted:
+            write(repo, file_path(i), 'ours\n', 'a')
+        git(repo, 'commit', '-q', '-a', '-m', 'ours', check=True)
+        git(repo, 'checkout', '-q', 'bench-other', check=True)
+        for i in conflicted:
+            write(repo, file_path(i), 'theirs\n', 'a')
+        git(repo, 'commit', '-q', '-a', '-m', 'theirs', check=True)
+        git(repo, 'checkout', '-q', '-', check=True)
+        git(repo, 'merge', 'bench-other')  # fails with conflicts, as intended
+    if case == 'tagged':
+        git(repo, 'tag', 'bench-v1', check=True)
+
+    for i in staged:
+        write(repo, file_path(i), 'staged\n', 'a')
+    if staged:
+        git(repo, 'add', '--', *[file_path(i) for i in staged], check=True)
+    for i in modified:
+        write(repo, file_path(i), 'modified\n', 'a')
+    for i in range(counts['untracked']):
+        # next to tracked files, so that git lists each of them instead of their directory
+        write(repo, os.path.join(os.path.dirname(file_path(i % size)), 'u%07d.txt' % i), 'untracked\n')
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def rank(p):
+        # nearest-rank percentile
+        return samples[max(0, min(len(samples) - 1, int(round(p / 100.0 * len(samples) + 0.5)) - 1))]
+    return {
+        'runs': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+    }
+
+
+def time_end_to_end(repo, runs, env):
+    """run gitstatus.py runs times, return latencies in ms and the peak RSS in KiB"""
+    latencies, peak_rss = [], 0
+    script = os.path.join(HERE, 'gitstatus.py')
+    for _ in range(runs):
+        start = time.perf_counter()
+        po = subprocess.Popen([sys.executable, script], cwd=repo, env=env, stdout=subprocess.DEVNULL)
+        _, _, rusage = os.wait4(po.pid, 0)
+        latencies.append((time.perf_counter() - start) * 1000)
+        peak_rss = max(peak_rss, rusage.ru_maxrss)
+    return latencies, peak_rss
+
+
+def time_phases(repo, runs, case, env):
+    """time the parts of gitstatus.py in this process, return latencies in ms per phase"""
+    saved = os.environ.copy()
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        found = gitstatus.find_repo(repo)
+        phases = {
+            'find_repo': lambda: gitstatus.find_repo(repo),
+            'get_stash': lambda: gitstatus.get_stash(repo),
+            'get_status': lambda: gitstatus.get_status(repo),
+        }
+        if os.environ.get('GITSTATUS_PORCELAIN_V2'):
+            phases['git_status'] = lambda: gitstatus.run_status(
+                ['--porcelain=v2', '--branch', '--show-stash', '-z'], repo, b'\0', {}, gitstatus.parse_porcelain_v2)
+        else:
+            phases['git_status'] = lambda: gitstatus.run_status(
+                ['--porcelain', '--branch'], repo, b'\n', {}, gitstatus.parse_porcelain_v1)
+        if case != 'branch':
+            phases['get_tagname_or_hash'] = lambda: gitstatus.get_tagname_or_hash(repo)
+        if found:
+            phases['get_fingerprint'] = lambda: gitstatus.get_fingerprint(*found)
+
+        results = {}
+        for name, phase in sorted(phases.items()):
+            samples = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                phase()
+                samples.append((time.perf_counter() - start) * 1000)
+            results[name] = percentiles(samples)
+        return results
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def compare(results, baseline, threshold):
+    """return the results whose p50 latency exceeds the one in baseline by more than threshold"""
+    def key(result):
+        return (result['size'], result['case'], json.dumps(result['env'], sort_keys=True))
+    previous = dict((key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before and result['end_to_end']['p50'] > before['end_to_end']['p50'] * threshold:
+            regressions.append({'size': result['size'], 'case': result['case'], 'env': result['env'],
+                                'baseline_p50': before['end_to_end']['p50'], 'p50': result['end_to_end']['p50']})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gitstatus.py on synthetic repositories.", prog="benchmark.py")
+    parser.add_argument('--sizes', default='1000,100000,1000000', help="comma-separated numbers of tracked files (default: %(default)s)")
+    parser.add_argument('--cases', default=','.join(CASES), help="comma-separated subset of %s (default: all)" % ', '.join(CASES))
+    parser.add_argument('--modified', type=float, default=0.01, help="fraction of files modified but not staged (default: %(default)s)")
+    parser.add_argument('--staged', type=float, default=0.01, help="fraction of files staged (default: %(default)s)")
+    parser.add_argument('--untracked', type=float, default=0.01, help="number of untracked files as a fraction of the size (default: %(default)s)")
+    parser.add_argument('--conflicted', type=float, default=0.001, help="fraction of files with merge conflicts (default: %(default)s)")
+    parser.add_argument('--stashes', type=int, default=3, help="number of stash entries (default: %(default)s)")
+    parser.add_argument('--runs', type=int, default=20, help="timed runs per repository and phase (default: %(default)s)")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help="environment for gitstatus.py, e.g. GITSTATUS_PORCELAIN_V2=1")
+    parser.add_argument('--workdir', default=os.path.join(os.environ.get('TMPDIR') or '/tmp', 'gitstatus-bench'),
+                        help="where generated repositories are kept (default: %(default)s)")
+    parser.add_argument('--compare', metavar='BASELINE', help="JSON output of a previous run to check for regressions")
+    parser.add_argument('--threshold', type=float, default=1.2, help="p50 ratio over the baseline that counts as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    overrides = dict(item.split('=', 1) for item in args.env)
+    env.update(overrides)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for case in args.cases.split(','):
+            name = 'n%d-%s-m%g-s%g-u%g-c%g-st%d' % (size, case, args.modified, args.staged, args.untracked, args.conflicted, args.stashes)
+            repo = os.path.join(args.workdir, name)
+            if not os.path.isdir(os.path.join(repo, '.git')):
+                print('generating %s' % repo, file=sys.stderr)
+                start = time.perf_counter()
+                generate(repo, size, case, args)
+                print('generated in %.1fs' % (time.perf_counter() - start), file=sys.stderr)
+
+            # one untimed run so that every measurement sees a refreshed index
+            subprocess.run([sys.executable, os.path.join(HERE, 'gitstatus.py')], cwd=repo, env=env, stdout=subprocess.DEVNULL)
+            latencies, peak_rss = time_end_to_end(repo, args.runs, env)
+            results.append({
+                'size': size,
+                'case': case,
+                'env': overrides,
+                'output': subprocess.run([sys.executable, os.path.join(HERE, 'gitstatus.py')], cwd=repo, env=env,
+                                         stdout=subprocess.PIPE).stdout.decode('utf-8'),
+                'end_to_end': percentiles(latencies),
+                'phases': time_phases(repo, args.runs, case, env),
+                'peak_rss_kb': peak_rss,
+            })
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'git': subprocess.run(['git', '--version'], stdout=subprocess.PIPE).stdout.decode('utf-8').strip(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = compare(results, json.load(f), args.threshold)
+        status = 1 if report['regressions'] else 0
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
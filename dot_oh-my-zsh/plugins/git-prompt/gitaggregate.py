@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Status of a repository together with its submodules and linked worktrees.
+
+`git status` in a superproject only tells whether each submodule is dirty, and
+finds out by running one status after the other. With
+GITSTATUS_AGGREGATE=submodules,worktrees (or 1 for both) gitstatus.py runs
+the top-level status with `--ignore-submodules=dirty` instead, and the status
+of every initialized submodule (recursively) and of every other worktree of
+the repository on a pool of GITSTATUS_AGGREGATE_JOBS threads (default 8). Their
+counters are added to those of the top-level repository, which keeps its
+branch and ahead/behind. Worktrees share their stash with the repository, so
+it is only counted once per common git directory. An `aggregated=<n>` field
+tells how many repositories were added.
+
+Run this file to get the status of each of them as JSON:
+
+    python3 gitaggregate.py [<path>]
+    {"path": "/home/me/src/project", "branch": "main", ..., "submodules": [{"path": "lib/foo", ...}], "worktrees": [...]}
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gitstatus
+
+# counter fields of a status line that are added up, see gitbatch.FIELDS
+SUMMED = (3, 4, 5, 6, 9)  # staged, conflicts, changed, untracked, deleted
+STASHED = 7
+CLEAN = 8
+
+
+def kinds():
+    """return the set of things GITSTATUS_AGGREGATE asks for, 'submodules' and/or 'worktrees'"""
+    value = os.environ.get('GITSTATUS_AGGREGATE') or ''
+    if value in ('1', 'all'):
+        return set(['submodules', 'worktrees'])
+    return set(kind.strip() for kind in value.split(',')) & set(['submodules', 'worktrees'])
+
+
+def find_submodules(root):
+    """return the worktree roots of the initialized submodules of root, nested ones included"""
+    from subprocess import check_output, CalledProcessError, DEVNULL
+
+    found = []
+    stack = [root]
+    while stack:
+        parent = stack.pop()
+        args = ['git', 'config', '--file', '.gitmodules', '-z', '--get-regexp', r'^submodule\..*\.path$']
+        try:
+            with gitstatus.Span('process', ' '.join(args)):
+                output = check_output(args, cwd=parent, stderr=DEVNULL)
+        except CalledProcessError:
+            continue  # no .gitmodules
+        for record in os.fsdecode(output).split('\0'):
+            path = record.partition('\n')[2]
+            if not path:
+                continue
+            path = os.path.normpath(os.path.join(parent, path))
+            # a submodule that was never cloned is just an empty directory
+            if os.path.exists(os.path.join(path, '.git')):
+                found.append(path)
+                stack.append(path)
+    return found
+
+
+def find_worktrees(root, common_dir):
+    """return the roots of the other worktrees sharing common_dir with root"""
+    candidates = []
+    if os.path.basename(common_dir) == '.git':
+        candidates.append(os.path.dirname(common_dir))  # the main worktree
+    try:
+        names = sorted(os.listdir(os.path.join(common_dir, 'worktrees')))
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            with open(os.path.join(common_dir, 'worktrees', name, 'gitdir')) as f:
+                candidates.append(os.path.dirname(os.path.normpath(f.read().strip())))
+        except IOError:
+            pass
+    root = os.path.realpath(root)
+    return [path for path in candidates if os.path.realpath(path) != root and os.path.isdir(path)]
+
+
+def _read_worktree(git_dir):
+    # the worktree root of an absorbed submodule, from core.worktree in its config
+    try:
+        with open(os.path.join(git_dir, 'config')) as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip().lower() == 'worktree':
+                    return os.path.normpath(os.path.join(git_dir, value.strip()))
+    except IOError:
+        pass
+    return None
+
+
+def fingerprint(git_dir, common_dir):
+    """return what get_fingerprint says of every submodule and worktree GITSTATUS_AGGREGATE adds, or None
+
+    Found from the git directories only, so that no git has to run: the absorbed
+    submodules under <common dir>/modules, nested ones included, and the worktrees
+    under <common dir>/worktrees along with the main one.
+    """
+    wanted = kinds()
+    repos = []  # (root, git dir, common dir)
+    if 'submodules' in wanted:
+        for parent, dirnames, filenames in os.walk(os.path.join(common_dir, 'modules')):
+            if 'HEAD' not in filenames:
+                continue
+            dirnames[:] = ['modules'] if 'modules' in dirnames else []
+            root = _read_worktree(parent)
+            if root:
+                repos.append((root, parent, parent))
+    if 'worktrees' in wanted:
+        if os.path.basename(common_dir) == '.git':
+            repos.append((os.path.dirname(common_dir), common_dir, common_dir))
+        try:
+            names = sorted(os.listdir(os.path.join(common_dir, 'worktrees')))
+        except OSError:
+            names = []
+        for name in names:
+            other = os.path.join(common_dir, 'worktrees', name)
+            try:
+                with open(os.path.join(other, 'gitdir')) as f:
+                    repos.append((os.path.dirname(os.path.normpath(f.read().strip())), other, common_dir))
+            except IOError:
+                pass
+    git_dir = os.path.realpath(git_dir)
+    parts = []
+    for root, other, other_common_dir in repos:
+        if os.path.realpath(other) == git_dir or not os.path.isdir(root):
+            continue
+        part = gitstatus.get_fingerprint(root, other, other_common_dir, aggregate=False)
+        if part is None:
+            return None
+        parts.append(part)
+    return ' '.join(parts)
+
+
+def _status(path, mode):
+    found = gitstatus.find_repo(path)
+    status = gitstatus.get_status(path, found[2] if found else None, mode, aggregate=False)
+    return status, found[2] if found else None
+
+
+def collect(cwd, mode='full'):
+    """return [(kind, root, status fields or None, common git dir)] of the repositories to aggregate with cwd"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    wanted = kinds()
+    found = gitstatus.find_repo(cwd or '.')
+    if found is None:
+        return []
+    root, git_dir, common_dir = found
+    repos = []
+    if 'submodules' in wanted and mode != 'no-submodules':
+        repos.extend(('submodule', path) for path in find_submodules(root))
+    if 'worktrees' in wanted:
+        repos.extend(('worktree', path) for path in find_worktrees(root, common_dir))
+    if not repos:
+        return []
+
+    jobs = int(os.environ.get('GITSTATUS_AGGREGATE_JOBS') or 8)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(jobs, len(repos))))
+    try:
+        futures = [executor.submit(_status, path, mode) for kind, path in repos]
+        results = [future.result() for future in futures]
+    finally:
+        # on GITSTATUS_TIMEOUT, don't start any more git processes
+        executor.shutdown(wait=False, cancel_futures=True)
+    return [(kind, path, repo_status, repo_common_dir)
+            for (kind, path), (repo_status, repo_common_dir) in zip(repos, results)]
+
+
+def _add(a, b):
+    # counters are capped as '<n>+' with GITSTATUS_MAX_COUNT, and so is their sum
+    total = int(a.rstrip('+')) + int(b.rstrip('+'))
+    return '%d+' % total if a.endswith('+') or b.endswith('+') else str(total)
+
+
+def rollup(status, others, common_dir):
+    """return status with the counters of the others added to its own"""
+    status = list(status)
+    stashes_seen = set([os.path.realpath(common_dir)] if common_dir else [])
+    count = 0
+    for kind, path, other, other_common_dir in others:
+        if other is None:
+            continue
+        count += 1
+        for i in SUMMED:
+            status[i] = _add(status[i], other[i])
+        if other[CLEAN] != '1':
+            status[CLEAN] = '0'
+        if other_common_dir and os.path.realpath(other_common_dir) not in stashes_seen:
+            stashes_seen.add(os.path.realpath(other_common_dir))
+            status[STASHED] = _add(status[STASHED], other[STASHED])
+    status.insert(10, 'aggregated=%d' % count)
+    return status
+
+
+def aggregate(cwd, status, mode='full'):
+    """return the status fields of cwd with those of its submodules and worktrees added, see kinds()"""
+    found = gitstatus.find_repo(cwd or '.')
+    others = collect(cwd, mode)
+    return rollup(status, others, found[2] if found else None) if others else status
+
+
+def main():
+    import json
+    import gitbatch
+
+    path = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else '.')
+    if not os.environ.get('GITSTATUS_AGGREGATE'):
+        os.environ['GITSTATUS_AGGREGATE'] = 'all'
+    found = gitstatus.find_repo(path)
+    status = gitstatus.get_status(path, found[2] if found else None, aggregate=False)
+    if status is None:
+        print(json.dumps({'path': path, 'error': 'not a git repository'}))
+        return 1
+    others = collect(path)
+    record = {'path': path}
+    record.update(gitbatch.parse_line(' '.join(rollup(status, others, found[2] if found else None))))
+    for kind, other_path, other, other_common_dir in others:
+        detail = {'path': os.path.relpath(other_path, found[0] if found else path)}
+        if other is None:
+            detail['error'] = 'not a git repository'
+        else:
+            detail.update(gitbatch.parse_line(' '.join(other)))
+        record.setdefault(kind + 's', []).append(detail)
+    print(json.dumps(record, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
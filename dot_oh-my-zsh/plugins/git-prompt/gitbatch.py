@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Status of many repositories at once, for dashboards and status bars.
+
+Takes repository roots or directories to search for repositories, computes
+the fields `gitstatus.py` prints for each of them on a bounded pool of
+threads (or processes) and writes one JSON object per repository to stdout as
+soon as it is done:
+
+    python3 gitbatch.py ~/src --depth 2
+    {"path": "/home/me/src/dotfiles", "branch": "master", "ahead": 0, ..., "deleted": 0}
+
+Repositories that fail are reported as {"path": ..., "error": ...}. The same
+GITSTATUS_* environment variables as for gitstatus.py apply, including the
+cache and the index backend.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gitstatus
+
+FIELDS = gitstatus.FIELDS
+# `key=value` fields that are counters too, see gitaggregate.rollup and gitstatus.get_line_counts
+COUNTED = ('aggregated', 'added', 'removed')
+
+
+def find_repos(path, depth):
+    """yield the roots of the repositories at path or up to depth directories below it"""
+    if os.path.exists(os.path.join(path, '.git')):
+        yield path
+        return
+    if depth <= 0:
+        return
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False) and entry.name != '.git':
+            for root in find_repos(entry.path, depth - 1):
+                yield root
+
+
+def parse_line(line):
+    """return a status line as a dict, with the counters as integers unless capped ('100+')"""
+    values = line.split(' ')
+    record = {}
+    for name, value in zip(FIELDS, values):
+        record[name] = int(value) if value.isdigit() and name != 'branch' else value
+    record['clean'] = bool(record.get('clean'))
+    for extra in values[len(FIELDS):]:
+        key, _, value = extra.partition('=')
+        record[key] = int(value) if value.isdigit() and key in COUNTED else value
+    return record
+
+
+def status_record(path):
+    """return the JSON-serializable status of the repository at path"""
+    try:
+        line = gitstatus.get_status_line(path)
+    except Exception as e:  # report it, the other repositories are still worth showing
+        return {'path': path, 'error': '%s: %s' % (type(e).__name__, e)}
+    if line is None:
+        return {'path': path, 'error': 'not a git repository'}
+    record = {'path': path}
+    record.update(parse_line(line))
+    return record
+
+
+def main():
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+    parser = argparse.ArgumentParser(description="Print the git prompt status of many repositories as JSON lines.",
+                                     prog="gitbatch.py")
+    parser.add_argument('paths', nargs='+', metavar='PATH', help="repository roots or directories containing repositories")
+    parser.add_argument('--depth', type=int, default=1,
+                        help="how many levels below each PATH to look for repositories (default: %(default)s)")
+    parser.add_argument('-j', '--jobs', type=int, default=min(32, (os.cpu_count() or 1) * 4),
+                        help="repositories handled at the same time (default: %(default)s)")
+    parser.add_argument('--processes', action='store_true',
+                        help="use worker processes instead of threads, e.g. with GITSTATUS_BACKEND=index, "
+                             "which runs Python code rather than waiting for git")
+    args = parser.parse_args()
+
+    roots = []
+    for path in args.paths:
+        path = os.path.abspath(path)
+        found = list(find_repos(path, args.depth))
+        # a path given explicitly is reported even if it isn't a repository
+        roots.extend(found or [path])
+    roots = list(dict.fromkeys(roots))
+
+    executor_class = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    with executor_class(max_workers=max(1, args.jobs)) as executor:
+        futures = [executor.submit(status_record, root) for root in roots]
+        try:
+            for future in as_completed(futures):
+                print(json.dumps(future.result(), sort_keys=True))
+                sys.stdout.flush()
+        except BrokenPipeError:  # e.g. piped into head, nobody wants the rest
+            for future in futures:
+                future.cancel()
+            sys.stdout = open(os.devnull, 'w')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
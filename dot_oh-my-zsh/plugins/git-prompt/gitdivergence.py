@@ -0,0 +1,167 @@
+"""Bounded ahead/behind counts for the git-prompt plugin.
+
+`git status --branch` counts the commits on either side of a branch and its
+upstream exactly, walking both histories down to their merge base. On
+branches that diverged by tens of thousands of commits that walk takes
+seconds, on every prompt.
+
+With GITSTATUS_AHEAD_BEHIND_LIMIT=<n>, gitstatus.py asks git not to count
+(`--no-ahead-behind`) and counts here instead. Both tips are walked together,
+newest commits first, as `git rev-list --parents` streams them. The walk stops
+as soon as only shared history is left, or after 2 * <n> commits. A side
+that wasn't fully counted by then is shown as '<count>+', and any count past
+<n> as '<n>+'. Results are cached per pair of commits, so no pair of commits
+is walked twice.
+"""
+import os
+
+import gitstatus
+
+HEAD = 1
+UPSTREAM = 2
+BOTH = HEAD | UPSTREAM
+
+
+def cache_path(head, upstream):
+    return os.path.join(gitstatus.cache_dir(), 'ahead-behind', '%s-%s' % (head, upstream))
+
+
+def read_cache(head, upstream, limit):
+    """return the cached (ahead, behind, ahead_complete, behind_complete) of the pair, or None"""
+    path = cache_path(head, upstream)
+    try:
+        with open(path) as f:
+            ahead, behind, cached_limit = f.read().split()
+        cached_limit = int(cached_limit)
+    except (IOError, ValueError):
+        return None
+    if ('+' in ahead or '+' in behind) and cached_limit < limit:
+        return None  # a longer walk may count more
+    try:
+        os.utime(path)  # mark as recently used
+    except OSError:
+        pass
+    return int(ahead.rstrip('+')), int(behind.rstrip('+')), '+' not in ahead, '+' not in behind
+
+
+def write_cache(head, upstream, counts, limit):
+    ahead, behind, ahead_complete, behind_complete = counts
+    gitstatus.write_file(cache_path(head, upstream), '%d%s %d%s %d\n' % (
+        ahead, '' if ahead_complete else '+', behind, '' if behind_complete else '+', limit))
+
+
+class Walk(object):
+    """flags telling which of the two tips reach each commit seen so far
+
+    A commit is counted as ahead (behind) while only HEAD (the upstream)
+    reaches it. rev-list prints commits newest first, so the flags of a commit
+    are usually final once it is printed. Commits dated the same second, as
+    left by rebases and scripts, can come out before their children though,
+    and then get their missing flag, and their printed ancestors with them,
+    when the child shows up.
+    """
+    __slots__ = ('waiting', 'printed', 'one_sided', 'counts')
+
+    def __init__(self, head, upstream):
+        self.waiting = {head: HEAD, upstream: UPSTREAM}  # seen as a parent, not printed yet
+        self.printed = {}  # commit -> [flags, parents]
+        self.one_sided = {HEAD: 1, UPSTREAM: 1, BOTH: 0}  # number of waiting commits per flags
+        self.counts = {HEAD: 0, UPSTREAM: 0, BOTH: 0}
+
+    def visit(self, commit, parents):
+        """record that rev-list printed commit, return its flags or 0 if nothing we walk reaches it"""
+        flags = self.waiting.pop(commit, 0)
+        if flags:
+            self.one_sided[flags] -= 1
+            self.counts[flags] += 1
+            self.printed[commit] = [flags, parents]
+            self.propagate(parents, flags)
+        return flags
+
+    def propagate(self, parents, flags):
+        stack = [(parents, flags)]
+        while stack:
+            parents, flags = stack.pop()
+            for parent in parents:
+                entry = self.printed.get(parent)
+                if entry is not None:
+                    if entry[0] | flags != entry[0]:
+                        self.counts[entry[0]] -= 1
+                        entry[0] |= flags
+                        self.counts[entry[0]] += 1
+                        stack.append((entry[1], entry[0]))
+                    continue
+                old = self.waiting.get(parent, 0)
+                if old | flags != old:
+                    if old:
+                        self.one_sided[old] -= 1
+                    self.waiting[parent] = old | flags
+                    self.one_sided[old | flags] += 1
+
+
+def walk(cwd, head, upstream, limit):
+    """count the commits only reachable from head and only from upstream
+
+    Returns (ahead, behind, ahead_complete, behind_complete). A side is
+    completely counted once no commit still waiting to be printed is reached by
+    its tip alone. Once both are, or the walk is out of budget, it goes on
+    through the commits dated no earlier than the oldest counted one, which
+    could still turn out to be reached by both tips through a commit of the
+    same date (barring clock skew).
+    """
+    from subprocess import Popen, PIPE, DEVNULL
+
+    state = Walk(head, upstream)
+    oldest = None  # timestamp of the oldest commit counted so far
+    draining = False
+    args = ['git', 'rev-list', '--timestamp', '--parents', head, upstream]
+    with gitstatus.Span('process', ' '.join(args)):
+        po = Popen(args, stdout=PIPE, stderr=DEVNULL, cwd=cwd)
+        with po:
+            try:
+                for line in po.stdout:
+                    oids = line.decode('ascii').split()
+                    timestamp = int(oids[0])
+                    if draining and (oldest is None or timestamp < oldest):
+                        break
+                    flags = state.visit(oids[1], oids[2:])
+                    if flags and flags != BOTH:
+                        oldest = timestamp if oldest is None else min(oldest, timestamp)
+                    if not draining:
+                        draining = ((not state.one_sided[HEAD] and not state.one_sided[UPSTREAM])
+                                    or len(state.printed) >= 2 * limit)
+            finally:
+                po.kill()
+    return state.counts[HEAD], state.counts[UPSTREAM], not state.one_sided[HEAD], not state.one_sided[UPSTREAM]
+
+
+def _format(count, complete, limit):
+    if count > limit:
+        return '%d+' % limit
+    return str(count) if complete else '%d+' % count
+
+
+@gitstatus.traced
+def ahead_behind(cwd, head, upstream, limit):
+    """return (ahead, behind) of commit head against commit upstream as strings, 'n+' if not fully counted"""
+    if head == upstream:
+        return '0', '0'
+    counts = read_cache(head, upstream, limit)
+    if counts is None:
+        counts = walk(cwd, head, upstream, limit)
+        write_cache(head, upstream, counts, limit)
+    ahead, behind, ahead_complete, behind_complete = counts
+    return _format(ahead, ahead_complete, limit), _format(behind, behind_complete, limit)
+
+
+def get_ahead_behind(cwd, limit, head=None):
+    """return (ahead, behind) of HEAD against its upstream, or ('0', '0') if it has none"""
+    from subprocess import check_output, CalledProcessError, DEVNULL
+
+    args = ['git', 'rev-parse', head or 'HEAD', '@{upstream}']
+    try:
+        with gitstatus.Span('process', ' '.join(args)):
+            head, upstream = check_output(args, cwd=cwd, stderr=DEVNULL).decode('ascii').split()
+    except (CalledProcessError, ValueError):
+        return '0', '0'  # no upstream, or it is gone
+    return ahead_behind(cwd, head, upstream, limit)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""fsmonitor hook for git, answered by the gitstatusd server.
+
+The largest costs of `git status` in big trees are the lstat() of every index
+entry and the scan for untracked files. With this hook as core.fsmonitor (hook
+protocol version 2) and core.untrackedCache turned on, git asks the hook which
+paths changed since its last call and only checks those:
+
+    python3 gitfsmonitor.py --install [<worktree>...]
+
+git runs the hook from the worktree root as `gitfsmonitor.py 2 <token>`. It
+asks gitstatusd, which watches the worktree with inotify (gitwatch.Journal),
+and prints the new token and the changed paths. If the server isn't running
+the hook starts it and fails, and git checks everything as it would without
+a hook. gitstatusd sets up the repositories it serves itself when
+GITSTATUS_FSMONITOR is set.
+"""
+import os
+import socket
+import sys
+
+
+def socket_path():
+    # same as gitstatusd.default_socket_path(), without importing the server
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(runtime_dir, 'gitstatusd-%d' % os.getuid(), 'socket')
+
+
+def is_private(path):
+    # same as gitstatusd.is_private()
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def hook_command():
+    """return the core.fsmonitor value that runs this hook"""
+    import shlex
+    return '%s %s' % (shlex.quote(sys.executable), shlex.quote(os.path.abspath(__file__)))
+
+
+def install(root):
+    """make this hook the fsmonitor of the repository at root and turn on its untracked cache
+
+    Returns False, and leaves the repository alone, if it already uses another fsmonitor.
+    """
+    from subprocess import check_output, check_call, CalledProcessError, DEVNULL
+
+    def git_config(*args):
+        return check_output(['git', 'config'] + list(args), cwd=root, stderr=DEVNULL).decode('utf-8').strip()
+
+    try:
+        try:
+            current = git_config('--get', 'core.fsmonitor')
+        except CalledProcessError:  # not set
+            current = ''
+        command = hook_command()
+        if current and current != command:
+            return False
+        if not current:
+            git_config('core.fsmonitor', command)
+            git_config('core.fsmonitorHookVersion', '2')
+        if git_config('--type=bool', '--default=false', '--get', 'core.untrackedCache') != 'true':
+            git_config('core.untrackedCache', 'true')
+            # add the extension now rather than on the next index write
+            check_call(['git', 'update-index', '--untracked-cache'], cwd=root, stdout=DEVNULL, stderr=DEVNULL)
+    except (CalledProcessError, OSError):
+        return False
+    return True
+
+
+def uninstall(root):
+    """remove this hook from the repository at root, returns False if it wasn't its fsmonitor"""
+    from subprocess import check_output, CalledProcessError, DEVNULL
+
+    try:
+        current = check_output(['git', 'config', '--get', 'core.fsmonitor'], cwd=root, stderr=DEVNULL)
+        if current.decode('utf-8').strip() != hook_command():
+            return False
+        for key in ('core.fsmonitor', 'core.fsmonitorHookVersion'):
+            check_output(['git', 'config', '--unset', key], cwd=root, stderr=DEVNULL)
+    except (CalledProcessError, OSError):
+        return False
+    return True
+
+
+def start_server(path):
+    from subprocess import Popen, DEVNULL
+
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gitstatusd.py')
+    Popen([sys.executable, server, '--socket', path], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+          cwd='/', start_new_session=True)
+
+
+def query(root, token):
+    """return the hook output for token from gitstatusd, or None if it can't tell"""
+    path = socket_path()
+    if not os.path.lexists(path):
+        start_server(path)
+        return None
+    if not (is_private(os.path.dirname(path)) and is_private(path)):
+        return None  # not our server, don't trust what it says changed
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            start_server(path)
+            return None
+        sock.sendall(('fsmonitor %s %s\n' % (token, root)).encode('utf-8', 'surrogateescape'))
+        reply = b''
+        while reply != b'\0' and not reply.endswith(b'\0\0'):
+            data = sock.recv(65536)
+            if not data:
+                return None
+            reply += data
+    finally:
+        sock.close()
+    return reply[:-1] or None
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '2':
+        output = query(os.getcwd(), sys.argv[2])
+        if output is None:
+            return 1
+        sys.stdout.buffer.write(output)
+        return 0
+    if len(sys.argv) == 3 and sys.argv[1] == '1':
+        return 1  # protocol version 1 has no tokens, git will retry with version 2
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Set up (or remove) gitstatusd as the fsmonitor of repositories.",
+                                     prog="gitfsmonitor.py")
+    parser.add_argument('--uninstall', action='store_true', help="remove the hook, keep the untracked cache")
+    parser.add_argument('--install', action='store_true', help="(default)")
+    parser.add_argument('paths', nargs='*', default=['.'], metavar='PATH', help="worktrees (default: .)")
+    args = parser.parse_args()
+    status = 0
+    for path in args.paths:
+        if not (uninstall(path) if args.uninstall else install(path)):
+            print("%s: another fsmonitor is configured or not a git repository" % path, file=sys.stderr)
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,902 @@
+"""Status of a repository read from its files, without running git.
+
+Memory-maps `.git/index` (versions 2 to 4, split or not), compares the stat
+data git cached for every entry with what `os.scandir` finds in the worktree,
+walks the untracked directories with a reimplementation of the gitignore rules
+and reads HEAD, refs and packed-refs for the branch name. This skips the
+fork/exec of git, which is most of the cost of a prompt in small repositories.
+
+Whatever can't be decided from the files alone raises Undecided, and
+get_status() then returns None so that gitstatus.py asks git instead: merges in
+progress, racily clean entries, submodules, files whose content would have to
+go through filters or attributes, unusual config. The untracked cache (UNTR)
+is read past but not used, its entries are only valid together with git's own
+exclude machinery.
+
+Used by gitstatus.py when GITSTATUS_BACKEND=index.
+"""
+import mmap
+import os
+import stat
+import struct
+import zlib
+
+import gitstatus
+
+_HEADER = struct.Struct('>4sII')
+# ctime s/ns, mtime s/ns, dev, ino, mode, uid, gid, size, sha-1, flags
+_ENTRY = struct.Struct('>10I20sH')
+_EXTENDED = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+
+FLAG_EXTENDED = 0x4000
+FLAG_SKIP_WORKTREE = 0x4000  # in the extended flags
+FLAG_INTENT_TO_ADD = 0x2000  # in the extended flags
+
+MODE_SYMLINK = 0o120000
+MODE_GITLINK = 0o160000
+NULL_OID = '0' * 40
+
+# environment variables that make git look somewhere find_repo() doesn't
+GIT_VARIABLES = ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_COMMON_DIR', 'GIT_INDEX_FILE', 'GIT_OBJECT_DIRECTORY',
+                 'GIT_NAMESPACE', 'GIT_CONFIG_PARAMETERS', 'GIT_CONFIG_COUNT')
+
+class Undecided(Exception):
+    """the answer needs git itself"""
+
+
+class Entry(object):
+    """one entry of the index"""
+    __slots__ = ('path', 'stage', 'mode', 'oid', 'size', 'mtime', 'mtime_ns', 'ctime', 'ctime_ns',
+                 'ino', 'uid', 'gid', 'skip_worktree', 'intent_to_add')
+
+
+def _varint(data, pos):
+    """decode the offset encoding of index v4 path prefixes and the untracked cache"""
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+
+def _ewah_positions(data, pos):
+    """return the set bits of the EWAH bitmap at pos and the position after it"""
+    bit_size, word_count = struct.unpack_from('>II', data, pos)
+    words = struct.unpack_from('>%dQ' % word_count, data, pos + 8)
+    positions = []
+    bit = 0
+    i = 0
+    while i < word_count:
+        # run length word: bit 0 is the running bit, then 32 bits of run length
+        # counted in words and 31 bits of literal words that follow
+        marker = words[i]
+        i += 1
+        run = ((marker >> 1) & 0xffffffff) * 64
+        if marker & 1:
+            positions.extend(range(bit, bit + run))
+        bit += run
+        for _ in range(marker >> 33):
+            word = words[i]
+            i += 1
+            while word:
+                low = word & -word
+                positions.append(bit + low.bit_length() - 1)
+                word ^= low
+            bit += 64
+    return [p for p in positions if p < bit_size], pos + 8 + 8 * word_count + 4
+
+
+def read_index(path):
+    """return (entries, extensions) of the index file at path
+
+    extensions maps the signatures of the extensions this module understands
+    ('TREE', 'link') to their raw data. Missing index files have no entries.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return [], {}
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < _HEADER.size + 20:
+            raise Undecided('truncated index')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _parse_index(data)
+    finally:
+        data.close()
+
+
+def _parse_index(data):
+    signature, version, count = _HEADER.unpack_from(data, 0)
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        raise Undecided('index version')
+    end = len(data) - 20  # trailing checksum
+    pos = _HEADER.size
+    entries = []
+    name = b''
+    for _ in range(count):
+        (ctime, ctime_ns, mtime, mtime_ns, _dev, ino, mode, uid, gid, size,
+         oid, flags) = _ENTRY.unpack_from(data, pos)
+        start = pos
+        pos += _ENTRY.size
+        extended = 0
+        if flags & FLAG_EXTENDED:
+            extended, = _EXTENDED.unpack_from(data, pos)
+            pos += _EXTENDED.size
+        if version == 4:
+            # the path is stored as the number of bytes to strip from the end of
+            # the previous path and the NUL-terminated suffix to append to it
+            strip, pos = _varint(data, pos)
+            nul = data.find(b'\0', pos)
+            name = name[:len(name) - strip] + data[pos:nul]
+            pos = nul + 1
+        else:
+            length = flags & 0xfff
+            if length == 0xfff:
+                length = data.find(b'\0', pos) - pos
+            name = data[pos:pos + length]
+            # entries are padded with 1-8 NULs to a multiple of 8 bytes
+            pos = start + ((pos - start + length + 8) & ~7)
+        entry = Entry()
+        entry.path = os.fsdecode(name)
+        entry.stage = (flags >> 12) & 3
+        entry.mode = mode
+        entry.oid = oid.hex()
+        entry.size = size
+        entry.mtime, entry.mtime_ns, entry.ctime, entry.ctime_ns = mtime, mtime_ns, ctime, ctime_ns
+        entry.ino, entry.uid, entry.gid = ino, uid, gid
+        entry.skip_worktree = bool(extended & FLAG_SKIP_WORKTREE)
+        entry.intent_to_add = bool(extended & FLAG_INTENT_TO_ADD)
+        entries.append(entry)
+
+    extensions = {}
+    while pos + 8 <= end:
+        signature, length = struct.unpack_from('>4sI', data, pos)
+        pos += 8
+        if signature in (b'TREE', b'link'):
+            extensions[signature.decode()] = data[pos:pos + length]
+        elif b'A' <= signature[:1] <= b'Z':
+            pass  # optional: UNTR, FSMN, REUC, EOIE, IEOT
+        else:
+            raise Undecided('index extension %r' % signature)  # e.g. 'sdir', a sparse index
+        pos += length
+    return entries, extensions
+
+
+def merge_split_index(entries, link, git_dir):
+    """apply the entries of a split index to the shared index its link extension names"""
+    shared = link[:20].hex()
+    if shared == NULL_OID:
+        return entries
+    base, _ = read_index(os.path.join(git_dir, 'sharedindex.' + shared))
+    deleted, replaced = [], []
+    if len(link) > 20:
+        deleted, pos = _ewah_positions(link, 20)
+        replaced, pos = _ewah_positions(link, pos)
+    new = iter(entries)
+    for position in replaced:
+        # replacements come first, in order, and carry no path of their own
+        entry = next(new)
+        entry.path = base[position].path
+        base[position] = entry
+    deleted = set(deleted)
+    return [entry for i, entry in enumerate(base) if i not in deleted] + list(new)
+
+
+def cache_tree_root(tree):
+    """return the tree oid the TREE extension records for the whole index, or None if invalidated"""
+    # "<path>\0<entry count> <subtree count>\n<oid>", the root comes first with an empty path
+    nul = tree.find(b'\0')
+    newline = tree.find(b'\n', nul)
+    if nul != 0 or newline < 0:
+        return None
+    entry_count = int(tree[nul + 1:newline].split(b' ')[0])
+    if entry_count < 0:
+        return None
+    return bytes(tree[newline + 1:newline + 21]).hex()
+
+
+def _parse_bool(value, default):
+    if value is None:
+        return default
+    value = value.lower()
+    if value in ('true', 'yes', 'on', '1', ''):
+        return True
+    if value in ('false', 'no', 'off', '0'):
+        return False
+    raise Undecided('config value %r' % value)
+
+
+class Config(object):
+    """the values of the config keys this module reads, from the files git would read them from"""
+
+    def __init__(self, git_dir, common_dir):
+        self.values = {}
+        # keys set in files git only includes conditionally ([includeIf]), which we don't evaluate
+        self.conditional = set()
+        home = os.path.expanduser('~')
+        xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.join(home, '.config')
+        files = []
+        if not os.environ.get('GIT_CONFIG_NOSYSTEM'):
+            files.append(os.environ.get('GIT_CONFIG_SYSTEM') or '/etc/gitconfig')
+        if 'GIT_CONFIG_GLOBAL' in os.environ:
+            files.append(os.environ['GIT_CONFIG_GLOBAL'])
+        else:
+            files.extend([os.path.join(xdg, 'git', 'config'), os.path.join(home, '.gitconfig')])
+        files.append(os.path.join(common_dir, 'config'))
+        for path in files:
+            self.read(path, self.values)
+        if self.get_bool('extensions.worktreeconfig', False):
+            self.read(os.path.join(git_dir, 'config.worktree'), self.values)
+
+    def read(self, path, values, depth=0):
+        try:
+            with open(path, 'rb') as f:
+                text = f.read().decode('utf-8', 'surrogateescape')
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for key, value in _parse_config(text):
+            values[key] = value
+            section = key.partition('.')[0]
+            if key.endswith('.path') and section in ('include', 'includeif') and depth < 10:
+                included = os.path.join(os.path.dirname(path), os.path.expanduser(value or ''))
+                if section == 'include':
+                    self.read(included, values, depth + 1)
+                else:
+                    maybe = {}
+                    self.read(included, maybe, depth + 1)
+                    self.conditional.update(maybe)
+
+    def get(self, key, default=None):
+        if key in self.conditional:
+            raise Undecided('%s is set in a conditional include' % key)
+        return self.values.get(key, default)
+
+    def get_bool(self, key, default):
+        return _parse_bool(self.get(key), default)
+
+
+def _parse_config(text):
+    """yield (key, value) for the variables of a config file, key as 'section[.subsection].name'"""
+    section = None
+    lines = iter(text.splitlines())
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            end = line.find(']')
+            if end < 0:
+                raise Undecided('config syntax')
+            header = line[1:end].strip()
+            name, _, subsection = header.partition(' ')
+            if subsection:
+                subsection = subsection.strip()
+                if len(subsection) < 2 or subsection[0] != '"' or subsection[-1] != '"':
+                    raise Undecided('config syntax')
+                subsection = subsection[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                section = '%s.%s' % (name.lower(), subsection)
+            else:
+                # [section.subsection] is the deprecated spelling of a lower case subsection
+                section = header.lower()
+            line = line[end + 1:].strip()
+        if not line or line[0] in '#;':
+            continue
+        if section is None:
+            raise Undecided('config syntax')
+        name, equals, raw = line.partition('=')
+        name = name.strip().lower()
+        if not equals:
+            yield '%s.%s' % (section, name), None  # a bare name is a true boolean
+            continue
+        value, quoted, escaped = [], False, False
+        keep = 0  # length of value without trailing unquoted whitespace
+        raw = raw.lstrip()
+        while True:
+            for c in raw:
+                if escaped:
+                    value.append({'n': '\n', 't': '\t', 'b': '\b'}.get(c, c))
+                    escaped = False
+                elif c == '\\':
+                    escaped = True
+                    continue
+                elif c == '"':
+                    quoted = not quoted
+                elif c in '#;' and not quoted:
+                    break
+                else:
+                    value.append(c)
+                    if c.isspace() and not quoted:
+                        continue
+                keep = len(value)
+            else:
+                if escaped:  # line continuation
+                    escaped = False
+                    raw = next(lines, '')
+                    continue
+            break
+        yield '%s.%s' % (section, name), ''.join(value[:keep])
+
+
+def _translate(pattern):
+    """return a regular expression for a gitignore glob, as git's wildmatch with WM_PATHNAME"""
+    import re
+
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if (pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/')
+                    and (i + 2 == n or pattern[i + 2] == '/')):
+                if i + 2 == n:
+                    out.append('.*')  # trailing '/**' matches everything inside
+                    i += 2
+                else:
+                    out.append('(?:.*/)?')  # '**/' matches zero or more directories
+                    i += 3
+                continue
+            while i < n and pattern[i] == '*':
+                i += 1
+            out.append('[^/]*')
+            continue
+        if c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 2 if pattern[j] == '\\' else 1
+            if j >= n:
+                out.append('\\[')
+            else:
+                body = pattern[i + 1:j]
+                if '[:' in body:
+                    raise Undecided('character class in %r' % pattern)
+                negate = body[:1] in ('!', '^')
+                if negate:
+                    body = body[1:]
+                body = body.replace('[', '\\[')
+                out.append('[^/%s]' % body if negate else '(?!/)[%s]' % body)
+                i = j
+        elif c == '\\':
+            i += 1
+            out.append(re.escape(pattern[i]) if i < n else '\\\\')
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile(''.join(out) + '\\Z', re.DOTALL)
+
+
+class Pattern(object):
+    """one line of a gitignore file"""
+    __slots__ = ('regex', 'negated', 'dir_only', 'anchored')
+
+    def __init__(self, line):
+        # trailing spaces are ignored unless escaped
+        stripped = line.rstrip(' ')
+        if stripped.endswith('\\') and len(stripped) < len(line):
+            stripped += ' '
+        line = stripped
+        self.negated = line.startswith('!')
+        if self.negated:
+            line = line[1:]
+        self.dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        # patterns with a slash other than a trailing one match relative to their file,
+        # others match the name at any level below it
+        self.anchored = '/' in line
+        self.regex = _translate(line.lstrip('/'))
+
+    def match(self, path, name, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        return self.regex.match(path if self.anchored else name) is not None
+
+
+def read_patterns(path):
+    """return the Patterns of the gitignore file at path"""
+    try:
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8', 'surrogateescape')
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return []
+    return [Pattern(line) for line in text.split('\n') if line and not line.startswith('#')]
+
+
+def is_ignored(rules, path, is_dir):
+    """return True if the worktree path is ignored by rules
+
+    rules is a list of (base directory, Patterns) in increasing precedence: the
+    global excludes, info/exclude and the .gitignore files from the root down.
+    Within one file the last matching pattern wins.
+    """
+    name = path.rpartition('/')[2]
+    for base, patterns in reversed(rules):
+        relative = path[len(base) + 1:] if base else path
+        for pattern in reversed(patterns):
+            if pattern.match(relative, name, is_dir):
+                return not pattern.negated
+    return False
+
+
+class Objects(object):
+    """reads commit and tag objects, loose or packed without deltas"""
+
+    def __init__(self, common_dir):
+        self.directory = os.path.join(common_dir, 'objects')
+        self.packs = None
+
+    def read(self, oid):
+        """return (type, content) of the object oid"""
+        try:
+            with open(os.path.join(self.directory, oid[:2], oid[2:]), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            return self._read_packed(oid)
+        header, _, content = data.partition(b'\0')
+        return header.split(b' ')[0].decode(), content
+
+    def _read_packed(self, oid):
+        if self.packs is None:
+            pack_dir = os.path.join(self.directory, 'pack')
+            try:
+                self.packs = sorted(os.path.join(pack_dir, name[:-4]) for name in os.listdir(pack_dir)
+                                    if name.endswith('.idx'))
+            except FileNotFoundError:
+                self.packs = []
+        binary = bytes.fromhex(oid)
+        for pack in self.packs:
+            offset = _pack_offset(pack + '.idx', binary)
+            if offset is None:
+                continue
+            with open(pack + '.pack', 'rb') as f:
+                f.seek(offset)
+                c = f.read(1)[0]
+                kind = (c >> 4) & 7
+                while c & 0x80:
+                    c = f.read(1)[0]
+                if kind not in (1, 2, 3, 4):
+                    raise Undecided('deltified object %s' % oid)
+                decompressor = zlib.decompressobj()
+                content = b''
+                while not decompressor.eof:
+                    chunk = f.read(4096)
+                    if not chunk:
+                        raise Undecided('truncated pack')
+                    content += decompressor.decompress(chunk)
+            return ('commit', 'tree', 'blob', 'tag')[kind - 1], content
+        raise Undecided('object %s not found' % oid)  # e.g. in an alternate object store
+
+
+def _pack_offset(idx_path, oid):
+    """return the offset of oid in the pack of a version 2 pack index, or None"""
+    with open(idx_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:8] != b'\377tOc\0\0\0\2':
+            raise Undecided('pack index version')
+        fanout = struct.unpack_from('>256I', data, 8)
+        count = fanout[255]
+        names = 8 + 1024
+        low = fanout[oid[0] - 1] if oid[0] else 0
+        high = fanout[oid[0]]
+        while low < high:
+            middle = (low + high) // 2
+            name = data[names + 20 * middle:names + 20 * middle + 20]
+            if name < oid:
+                low = middle + 1
+            elif name > oid:
+                high = middle
+            else:
+                offsets = names + 24 * count  # past the names and their CRC32s
+                offset, = _U32.unpack_from(data, offsets + 4 * middle)
+                if offset & 0x80000000:
+                    offset, = struct.unpack_from('>Q', data, offsets + 4 * count + 8 * (offset & 0x7fffffff))
+                return offset
+        return None
+    finally:
+        data.close()
+
+
+def _version_key(name):
+    """sort key of git's version:refname ordering, e.g. v1.10 after v1.9"""
+    import re
+
+    return [int(part) if i % 2 else part for i, part in enumerate(re.split(r'(\d+)', name))]
+
+
+class Repository(object):
+    """reads the status of one worktree from its files"""
+
+    def __init__(self, root, git_dir, common_dir):
+        self.root = root
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self._packed_refs = None
+        self.objects = Objects(common_dir)
+
+    # refs
+
+    def packed_refs(self):
+        """return {refname: (oid, peeled oid or None)} from packed-refs"""
+        if self._packed_refs is None:
+            self._packed_refs = refs = {}
+            try:
+                with open(os.path.join(self.common_dir, 'packed-refs')) as f:
+                    last = None
+                    for line in f:
+                        if line.startswith('#'):
+                            continue
+                        if line.startswith('^'):
+                            refs[last] = (refs[last][0], line[1:].strip())
+                            continue
+                        oid, _, last = line.rstrip('\n').partition(' ')
+                        refs[last] = (oid, None)
+            except FileNotFoundError:
+                pass
+        return self._packed_refs
+
+    def read_ref(self, name, depth=0):
+        """return the oid name points to, following symbolic refs, or None if it doesn't exist"""
+        per_worktree = name == 'HEAD' or not name.startswith('refs/') or name.startswith(
+            ('refs/bisect/', 'refs/worktree/', 'refs/rewritten/'))
+        try:
+            with open(os.path.join(self.git_dir if per_worktree else self.common_dir, name)) as f:
+                content = f.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            packed = self.packed_refs().get(name)
+            return packed[0] if packed else None
+        if content.startswith('ref: '):
+            if depth > 5:
+                raise Undecided('symbolic ref loop')
+            return self.read_ref(content[len('ref: '):], depth + 1)
+        if len(content) != 40:
+            raise Undecided('ref %s' % name)
+        return content
+
+    def tags_pointing_at(self, oid):
+        """return the short names of the tags that point at oid, peeled"""
+        tags = set()
+        for name, (target, peeled) in self.packed_refs().items():
+            if name.startswith('refs/tags/') and oid in (target, peeled):
+                tags.add(name[len('refs/tags/'):])
+        top = os.path.join(self.common_dir, 'refs', 'tags')
+        for directory, _, files in os.walk(top):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, top).replace(os.sep, '/')
+                with open(path) as f:
+                    target = f.read().strip()
+                tags.discard(name)  # loose refs take precedence over packed ones
+                if self._peel(target) == oid:
+                    tags.add(name)
+        return sorted(tags, key=_version_key, reverse=True)
+
+    def _peel(self, oid):
+        for _ in range(10):
+            kind, content = self.objects.read(oid)
+            if kind != 'tag':
+                return oid
+            oid = content[len(b'object '):len(b'object ') + 40].decode()
+        raise Undecided('tag chain')
+
+    def upstream(self, config, branch):
+        """return the remote-tracking ref and the short name of the upstream of branch, or (None, None)"""
+        remote = config.get('branch.%s.remote' % branch)
+        merge = config.get('branch.%s.merge' % branch)
+        if not remote or not merge:
+            return None, None
+        if not merge.startswith('refs/'):
+            raise Undecided('branch.%s.merge' % branch)
+        if remote == '.':
+            tracking = merge
+        else:
+            # map the remote ref with the remote's fetch refspecs, which the config
+            # parser only keeps the last of, so rely on the default layout
+            fetch = config.get('remote.%s.fetch' % remote)
+            if fetch is None or fetch.lstrip('+') != 'refs/heads/*:refs/remotes/%s/*' % remote:
+                raise Undecided('remote.%s.fetch' % remote)
+            if not merge.startswith('refs/heads/'):
+                return None, None
+            tracking = 'refs/remotes/%s/%s' % (remote, merge[len('refs/heads/'):])
+        for prefix in ('refs/heads/', 'refs/remotes/'):
+            if tracking.startswith(prefix):
+                return tracking, tracking[len(prefix):]
+        return tracking, tracking
+
+    def head_tree(self, oid):
+        kind, content = self.objects.read(oid)
+        if kind != 'commit' or not content.startswith(b'tree '):
+            raise Undecided('HEAD is not a commit')
+        return content[len(b'tree '):len(b'tree ') + 40].decode()
+
+    # worktree
+
+    def status(self):
+        """return the prompt fields in the format of gitstatus.get_status"""
+        from os.path import exists, join
+
+        for name in ('MERGE_HEAD', 'reftable'):
+            if exists(join(self.git_dir, name)) or exists(join(self.common_dir, name)):
+                raise Undecided(name)
+        config = Config(self.git_dir, self.common_dir)
+        if (config.get('extensions.objectformat', 'sha1').lower() != 'sha1' or config.get('extensions.refstorage')
+                or config.get('core.worktree') or config.get_bool('core.bare', False)
+                or config.get_bool('core.ignorecase', False)):
+            raise Undecided('repository format')
+
+        with open(join(self.git_dir, 'HEAD')) as f:
+            head_ref = f.read().strip()
+        head = self.read_ref('HEAD')
+        branch = None
+        if head_ref.startswith('ref: '):
+            head_ref = head_ref[len('ref: '):]
+            if not head_ref.startswith('refs/heads/'):
+                raise Undecided('HEAD')
+            branch = head_ref[len('refs/heads/'):]
+
+        index_path = join(self.git_dir, 'index')
+        try:
+            index_mtime = os.stat(index_path).st_mtime_ns // 1000000000
+        except FileNotFoundError:
+            index_mtime = 0
+        entries, extensions = read_index(index_path)
+        if 'link' in extensions:
+            entries = merge_split_index(entries, extensions['link'], self.git_dir)
+
+        counts = gitstatus.Counts(int(os.environ.get('GITSTATUS_MAX_COUNT') or 0))
+        for entry in entries:
+            if entry.stage or entry.mode == MODE_GITLINK:
+                raise Undecided('conflict or submodule at %s' % entry.path)
+
+        # index against HEAD: unless HEAD is unborn, this needs the cache tree of the
+        # index to be valid and equal to the tree of HEAD, we don't diff trees here
+        if head is None:
+            counts.staged = sum(1 for entry in entries if not entry.intent_to_add)
+        else:
+            tree = cache_tree_root(extensions['TREE']) if 'TREE' in extensions else None
+            if tree is None or tree != self.head_tree(head):
+                raise Undecided('staged changes')
+
+        self.config = config
+        self.counts = counts
+        self.index_mtime = index_mtime
+        self._worktree(entries)
+
+        ahead, behind, upstream = 0, 0, ''
+        if branch is None:
+            tags = self.tags_pointing_at(head)
+            branch = tags[0] + ('+' if len(tags) > 1 else '') if tags else head[:7]
+        elif head is not None:
+            tracking, upstream = self.upstream(config, branch)
+            upstream_oid = self.read_ref(tracking) if tracking else None
+            if upstream_oid is not None and upstream_oid != head:
+                ahead, behind = self._ahead_behind(head, tracking, upstream_oid)
+        fields = gitstatus.make_fields(branch, ahead, behind, counts, gitstatus.get_stash(self.root, self.common_dir))
+        if os.environ.get('GITSTATUS_PORCELAIN_V2'):
+            fields.append('upstream=%s' % (upstream or ''))
+        return fields
+
+    def _ahead_behind(self, head, tracking, upstream_oid):
+        limit = gitstatus.ahead_behind_limit()
+        if limit:
+            import gitdivergence
+            return gitdivergence.ahead_behind(self.root, head, upstream_oid, limit)
+
+        # walking the commit graph is left to git
+        from subprocess import check_output, CalledProcessError, DEVNULL
+
+        args = ['git', 'rev-list', '--left-right', '--count', 'HEAD...%s' % tracking]
+        try:
+            with gitstatus.Span('process', ' '.join(args)):
+                output = check_output(args, cwd=self.root, stderr=DEVNULL)
+        except CalledProcessError:
+            raise Undecided('rev-list')
+        ahead, behind = output.split()
+        return int(ahead), int(behind)
+
+    def _worktree(self, entries):
+        config = self.config
+        self.filemode = config.get_bool('core.filemode', True)
+        self.symlinks = config.get_bool('core.symlinks', True)
+        self.trustctime = config.get_bool('core.trustctime', True)
+        self.checkstat = (config.get('core.checkstat') or 'default').lower() != 'minimal'
+        self.untracked_mode = (config.get('status.showuntrackedfiles') or 'normal').lower()
+        if self.untracked_mode not in ('no', 'normal', 'all'):
+            raise Undecided('status.showUntrackedFiles')
+
+        # content comparisons hash the worktree file, which is wrong as soon as
+        # filters, end of line conversion or attributes could apply to it
+        xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+        attributes = [os.path.join(self.common_dir, 'info', 'attributes'), '/etc/gitattributes',
+                      os.path.expanduser(config.get('core.attributesfile') or os.path.join(xdg, 'git', 'attributes'))]
+        self.can_hash = not (
+            _parse_bool(config.get('core.autocrlf'), False) or (config.get('core.autocrlf') or '').lower() == 'input'
+            or any(os.path.exists(path) for path in attributes)
+            or any(entry.path.rpartition('/')[2] == '.gitattributes' for entry in entries))
+
+        # tracked files by directory, and the directories that hold tracked files
+        self.files = {'': {}}
+        self.subdirs = {'': set()}
+        for entry in entries:
+            directory, _, name = entry.path.rpartition('/')
+            files = self.files.get(directory)
+            if files is None:
+                files = self.files[directory] = {}
+                child = directory
+                while True:
+                    parent, _, child_name = child.rpartition('/')
+                    known = parent in self.subdirs
+                    self.subdirs.setdefault(parent, set()).add(child_name)
+                    self.subdirs.setdefault(child, set())
+                    self.files.setdefault(child, {})
+                    if known:
+                        break
+                    child = parent
+            files[name] = entry
+
+        rules = []
+        if self.untracked_mode != 'no':
+            excludes = config.get('core.excludesfile') or os.path.join(xdg, 'git', 'ignore')
+            rules.append(('', read_patterns(os.path.expanduser(excludes))))
+            rules.append(('', read_patterns(os.path.join(self.common_dir, 'info', 'exclude'))))
+        self._walk_tracked('', self.root, rules, False)
+
+    def _rules(self, rules, rel, path):
+        if self.untracked_mode == 'no':
+            return rules
+        patterns = read_patterns(os.path.join(path, '.gitignore'))
+        return rules + [(rel, patterns)] if patterns else rules
+
+    def _deleted(self, rel):
+        """count every tracked file below rel as deleted"""
+        for entry in self.files[rel].values():
+            if not entry.skip_worktree:
+                self.counts.add(' ', 'D')
+        for name in self.subdirs[rel]:
+            self._deleted(rel + '/' + name if rel else name)
+
+    def _walk_tracked(self, rel, path, rules, ignored):
+        """compare the tracked files of directory rel with the worktree, then recurse"""
+        files = self.files[rel]
+        subdirs = self.subdirs[rel]
+        try:
+            scan = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            self._deleted(rel)
+            return
+        rules = self._rules(rules, rel, path)
+        seen = set()
+        for dir_entry in scan:
+            name = dir_entry.name
+            if name == '.git':
+                continue
+            child = rel + '/' + name if rel else name
+            entry = files.get(name)
+            is_dir = dir_entry.is_dir(follow_symlinks=False)
+            if entry is not None:
+                seen.add(name)
+                self._compare(entry, dir_entry)
+                # git doesn't list a directory in place of a tracked file, only its files with -uall
+                if not is_dir or self.untracked_mode != 'all':
+                    continue
+            if name in subdirs:
+                seen.add(name)
+                if is_dir:
+                    # untracked files in an ignored directory stay ignored, even next to tracked ones
+                    child_ignored = ignored or (self.untracked_mode != 'no' and is_ignored(rules, child, True))
+                    self._walk_tracked(child, dir_entry.path, rules, child_ignored)
+                    continue
+                self._deleted(child)
+            if self.untracked_mode == 'no' or ignored or is_ignored(rules, child, is_dir):
+                continue
+            if is_dir:
+                count = self._untracked_dir(child, dir_entry.path, rules)
+            else:
+                count = 1
+            self.counts.untracked += count
+        for name in files:
+            if name not in seen and not files[name].skip_worktree:
+                self.counts.add(' ', 'D')
+        for name in subdirs:
+            if name not in seen:
+                self._deleted(rel + '/' + name if rel else name)
+
+    def _untracked_dir(self, rel, path, rules):
+        """return how many untracked entries git lists for directory rel, which holds no tracked files"""
+        if os.path.lexists(os.path.join(path, '.git')):
+            return 1  # another repository, listed as a whole
+        try:
+            scan = list(os.scandir(path))
+        except OSError:
+            return 0
+        rules = self._rules(rules, rel, path)
+        count = 0
+        for dir_entry in scan:
+            if dir_entry.name == '.git':
+                continue
+            child = rel + '/' + dir_entry.name
+            is_dir = dir_entry.is_dir(follow_symlinks=False)
+            if is_ignored(rules, child, is_dir):
+                continue
+            count += self._untracked_dir(child, dir_entry.path, rules) if is_dir else 1
+            if count and self.untracked_mode == 'normal':
+                return 1  # listed as the directory itself
+        return count
+
+    def _compare(self, entry, dir_entry):
+        """count the worktree file of entry if it is modified or deleted"""
+        if entry.skip_worktree or entry.intent_to_add:
+            return  # not checked out, or shown as ' A', which isn't counted
+        st = dir_entry.stat(follow_symlinks=False)
+        mode = st.st_mode
+        if stat.S_ISLNK(mode):
+            worktree_mode = MODE_SYMLINK if self.symlinks else entry.mode
+        elif stat.S_ISREG(mode):
+            if self.filemode or entry.mode == MODE_SYMLINK:
+                worktree_mode = 0o100755 if mode & 0o100 else 0o100644
+            else:
+                worktree_mode = entry.mode
+        elif stat.S_ISDIR(mode):
+            self.counts.add(' ', 'D')  # replaced by a directory
+            return
+        else:
+            raise Undecided('file type of %s' % entry.path)
+
+        if stat.S_IFMT(worktree_mode) != stat.S_IFMT(entry.mode):
+            return  # a type change, 'T', which isn't counted
+        if worktree_mode != entry.mode:
+            self.counts.add(' ', 'M')
+            return
+
+        mtime_ns = st.st_mtime_ns
+        size = st.st_size & 0xffffffff
+        same = (mtime_ns // 1000000000 & 0xffffffff == entry.mtime and size == entry.size
+                and (not entry.mtime_ns or mtime_ns % 1000000000 == entry.mtime_ns))
+        if same and self.checkstat:
+            same = ((st.st_ino & 0xffffffff) == entry.ino and st.st_uid == entry.uid and st.st_gid == entry.gid
+                    and (not self.trustctime or st.st_ctime_ns // 1000000000 & 0xffffffff == entry.ctime))
+        if same:
+            if entry.mtime >= self.index_mtime:
+                # written in the same second as the index, it may have changed since
+                raise Undecided('racily clean %s' % entry.path)
+            return
+        if size != entry.size and entry.size != 0:
+            # a size of 0 is how git marks entries whose size it has to check again
+            self.counts.add(' ', 'M')
+            return
+        if self._hash(entry, dir_entry.path, stat.S_ISLNK(mode)) != entry.oid:
+            self.counts.add(' ', 'M')
+
+    def _hash(self, entry, path, is_link):
+        import hashlib
+
+        if not self.can_hash:
+            raise Undecided('content of %s' % entry.path)
+        if is_link:
+            content = os.fsencode(os.readlink(path))
+        else:
+            with open(path, 'rb') as f:
+                content = f.read()
+        return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
+def get_status(cwd=None):
+    """return the prompt fields of the repository at cwd like gitstatus.get_status, or None to ask git"""
+    if any(name in os.environ for name in GIT_VARIABLES):
+        return None
+    found = gitstatus.find_repo(cwd or '.')
+    if found is None:
+        return None
+    try:
+        with gitstatus.Span('phase', 'gitindex'):
+            return Repository(*found).status()
+    except (Undecided, OSError, ValueError, IndexError, KeyError, StopIteration, struct.error, zlib.error):
+        return None
@@ -0,0 +1,156 @@
+"""Lines added and removed in the worktree, for the git-prompt plugin.
+
+With GITSTATUS_LINES=1 gitstatus.py appends `added=<n> removed=<n>` to its
+output: the totals of `git diff --numstat`, i.e. of the unstaged changes. That
+diff reads every modified file in full, on every prompt, so its results are
+kept per file in `lines/` under the cache directory, keyed on the blob of the
+file in the index and on the size and mtime of the file in the worktree. Only
+the files `git status` just reported as modified or deleted, and that changed
+since they were last counted, are diffed again, split over up to
+GITSTATUS_LINES_JOBS (default 4) git processes.
+"""
+import json
+import os
+import time
+
+import gitstatus
+
+GITLINK = '160000'
+
+
+def cache_path(root):
+    return os.path.join(gitstatus.cache_dir(), 'lines', root.replace(os.sep, '%'))
+
+
+def read_cache(root):
+    """return {path: [index oid, mtime_ns, size, added, removed]} as last stored for root"""
+    try:
+        with open(cache_path(root)) as f:
+            entries = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+def write_cache(root, entries):
+    gitstatus.write_file(cache_path(root), json.dumps(entries, separators=(',', ':')))
+
+
+def index_entries(root, paths):
+    """return {path: (mode, oid)} of the index entries of paths"""
+    from subprocess import check_output, CalledProcessError, DEVNULL
+
+    args = ['git', 'ls-files', '--stage', '-z', '--']
+    env = dict(os.environ, GIT_LITERAL_PATHSPECS='1')
+    try:
+        with gitstatus.Span('process', ' '.join(args)):
+            output = check_output(args + paths, cwd=root, env=env, stderr=DEVNULL)
+    except (CalledProcessError, OSError):
+        return {}
+    entries = {}
+    for record in output.decode('utf-8', 'surrogateescape').split('\0'):
+        info, _, path = record.partition('\t')
+        if path:
+            mode, oid, stage = info.split(' ')
+            if stage == '0':
+                entries[path] = (mode, oid)
+    return entries
+
+
+def numstat(root, paths):
+    """return {path: (added, removed)} for paths from one `git diff --numstat`, or None if git failed
+
+    Binary files count 0 lines.
+    """
+    from subprocess import check_output, CalledProcessError, DEVNULL
+
+    args = ['git', 'diff', '--numstat', '--no-renames', '--no-ext-diff', '-z', '--']
+    env = dict(os.environ, GIT_LITERAL_PATHSPECS='1', GIT_OPTIONAL_LOCKS='0')
+    try:
+        with gitstatus.Span('process', ' '.join(args)):
+            output = check_output(args + paths, cwd=root, env=env, stderr=DEVNULL)
+    except (CalledProcessError, OSError):
+        return None
+    counts = {}
+    for record in output.decode('utf-8', 'surrogateescape').split('\0'):
+        fields = record.split('\t', 2)
+        if len(fields) == 3:
+            added, removed, path = fields
+            counts[path] = (int(added) if added != '-' else 0, int(removed) if removed != '-' else 0)
+    return counts
+
+
+def _stat(root, path):
+    try:
+        st = os.lstat(os.path.join(root, path))
+    except OSError:
+        return -1, -1  # deleted
+    return st.st_mtime_ns, st.st_size
+
+
+def diff_all(root, paths):
+    """return numstat() of paths, running up to GITSTATUS_LINES_JOBS git processes at once"""
+    jobs = max(1, min(int(os.environ.get('GITSTATUS_LINES_JOBS') or 4), len(paths)))
+    if jobs == 1:
+        return numstat(root, paths)
+    from concurrent.futures import ThreadPoolExecutor
+
+    counts = {}
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for result in executor.map(numstat, [root] * jobs, [paths[i::jobs] for i in range(jobs)]):
+            if result is None:
+                return None
+            counts.update(result)
+    finally:
+        # on GITSTATUS_TIMEOUT, don't start any more git processes
+        executor.shutdown(wait=False, cancel_futures=True)
+    return counts
+
+
+@gitstatus.traced
+def line_counts(root, changes):
+    """return (added, removed) over changes, a list of (path, index mode, index oid)
+
+    The mode and oid may be None when the status didn't tell, they are then
+    looked up in the index.
+    """
+    unknown = [path for path, mode, oid in changes if oid is None]
+    if unknown:
+        found = index_entries(root, unknown)
+        changes = [(path, mode, oid) if oid is not None else (path,) + found.get(path, (None, None))
+                   for path, mode, oid in changes]
+
+    cached = read_cache(root)
+    entries = {}
+    misses = []
+    for path, mode, oid in changes:
+        if oid is None or mode == GITLINK:
+            continue
+        # stat before diffing, so that a file written in between is diffed again next time
+        key = [oid, *_stat(root, path)]
+        entry = cached.get(path)
+        if entry is not None and entry[:3] == key:
+            entries[path] = entry
+        else:
+            entries[path] = key + [0, 0]
+            misses.append(path)
+    if misses:
+        diffed = diff_all(root, misses)
+        if diffed is None:
+            # count what we can and retry the rest next time
+            for path in misses:
+                del entries[path]
+        else:
+            for path, counts in diffed.items():
+                if path in entries:
+                    entries[path][3:] = counts
+            # a file written again within the timestamp granularity keeps its mtime, don't trust those
+            racy = time.time_ns() - 2 * 10 ** 9
+            for path in misses:
+                if entries[path][1] > racy:
+                    entries[path][1] = None
+    # files that are no longer modified are dropped, which keeps the cache small
+    if misses or len(entries) != len(cached):
+        write_cache(root, entries)
+    return sum(entry[3] for entry in entries.values()), sum(entry[4] for entry in entries.values())
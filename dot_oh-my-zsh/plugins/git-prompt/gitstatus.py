@@ -3,19 +3,120 @@ from __future__ import print_function
 
 import os
 import sys
-import re
-from subprocess import Popen, PIPE, check_output
+import time
 
+# subprocess is imported by the functions that run git, so that answering
+# from the status cache doesn't pay for importing it
 
-def get_tagname_or_hash():
+# records of the current run for GITSTATUS_TRACE, None unless main() enabled tracing
+_trace = None
+_trace_start = 0.0
+
+
+def _cpu_time(kind):
+    if kind == 'process':
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+    return time.process_time()
+
+
+class Span(object):
+    """time a block for the GITSTATUS_TRACE log, either a phase or a git process
+
+    CPU time is that of this process for phases and that of the waited-for child
+    processes for git processes. Does nothing unless tracing is enabled.
+    """
+    __slots__ = ('kind', 'name', 'start', 'cpu')
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        if _trace is not None:
+            self.start = time.perf_counter()
+            self.cpu = _cpu_time(self.kind)
+        return self
+
+    def __exit__(self, *exc_info):
+        if _trace is not None:
+            _trace.append({
+                'kind': self.kind,
+                'name': self.name,
+                'start_ms': round((self.start - _trace_start) * 1000, 3),
+                'wall_ms': round((time.perf_counter() - self.start) * 1000, 3),
+                'cpu_ms': round((_cpu_time(self.kind) - self.cpu) * 1000, 3),
+            })
+
+
+def traced(function):
+    """record every call of function as a phase in the GITSTATUS_TRACE log"""
+    def wrapper(*args, **kwargs):
+        if _trace is None:
+            return function(*args, **kwargs)
+        with Span('phase', function.__name__):
+            return function(*args, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+@traced
+def find_repo(path):
+    """return (worktree root, git dir, common git dir) of the repository containing path
+
+    Only walks up the directory tree looking for `.git`, so it never forks. Returns
+    None if no repository is found, in which case callers should fall back to git.
+    """
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        if os.path.isfile(dot_git):
+            # linked worktrees and submodules use a `gitdir: <path>` file
+            try:
+                with open(dot_git) as f:
+                    content = f.read().strip()
+            except IOError:
+                return None
+            if not content.startswith('gitdir:'):
+                return None
+            git_dir = os.path.normpath(os.path.join(path, content[len('gitdir:'):].strip()))
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    except IOError:
+        pass
+    return path, git_dir, common_dir
+
+
+@traced
+def get_tagname_or_hash(cwd=None, oid=None):
     """return tagname if exists else hash"""
+    from subprocess import check_output
+
     # get hash
-    hash_cmd = ['git', 'rev-parse', '--short', 'HEAD']
-    hash_ = check_output(hash_cmd).decode('utf-8').strip()
+    if oid is None:
+        hash_cmd = ['git', 'rev-parse', '--short', 'HEAD']
+        with Span('process', ' '.join(hash_cmd)):
+            hash_ = check_output(hash_cmd, cwd=cwd).decode('utf-8').strip()
+    else:
+        hash_ = oid[:7]
 
     # get tagname
-    tags_cmd = ['git', 'for-each-ref', '--points-at=HEAD', '--count=2', '--sort=-version:refname', '--format=%(refname:short)', 'refs/tags']
-    tags = check_output(tags_cmd).decode('utf-8').split()
+    tags_cmd = ['git', 'for-each-ref', '--points-at=%s' % (oid or 'HEAD'), '--count=2', '--sort=-version:refname', '--format=%(refname:short)', 'refs/tags']
+    with Span('process', ' '.join(tags_cmd)):
+        tags = check_output(tags_cmd, cwd=cwd).decode('utf-8').split()
 
     if tags:
         return tags[0] + ('+' if len(tags) > 1 else '')
@@ -25,10 +126,17 @@ def get_tagname_or_hash():
 
 # Re-use method from https://github.com/magicmonty/bash-git-prompt to get stash count
 # Use `--git-common-dir` to avoid problems with git worktrees, which don't have individual stashes
-def get_stash():
-    cmd = Popen(['git', 'rev-parse', '--git-common-dir'], stdout=PIPE, stderr=PIPE)
-    so, se = cmd.communicate()
-    stash_file = '%s%s' % (so.decode('utf-8').rstrip(), '/logs/refs/stash')
+@traced
+def get_stash(cwd=None, git_common_dir=None):
+    if git_common_dir is None:
+        from subprocess import Popen, PIPE
+        with Span('process', 'git rev-parse --git-common-dir'):
+            cmd = Popen(['git', 'rev-parse', '--git-common-dir'], stdout=PIPE, stderr=PIPE, cwd=cwd)
+            so, se = cmd.communicate()
+        git_common_dir = so.decode('utf-8').rstrip()
+        if cwd is not None:
+            git_common_dir = os.path.join(cwd, git_common_dir)
+    stash_file = '%s%s' % (git_common_dir, '/logs/refs/stash')
 
     try:
         with open(stash_file) as f:
@@ -36,68 +144,804 @@ def get_stash():
     except IOError:
         return 0
 
-# `git status --porcelain --branch` can collect all information
-# branch, remote_branch, untracked, staged, changed, conflicts, ahead, behind
-po = Popen(['git', 'status', '--porcelain', '--branch'], env=dict(os.environ, LANG="C"), stdout=PIPE, stderr=PIPE)
-stdout, sterr = po.communicate()
-if po.returncode != 0:
-    sys.exit(0)  # Not a git repository
-
-# collect git status information
-untracked, staged, changed, deleted, conflicts = [], [], [], [], []
-ahead, behind = 0, 0
-status = [(line[0], line[1], line[2:]) for line in stdout.decode('utf-8').splitlines()]
-for st in status:
-    if st[0] == '#' and st[1] == '#':
-        if re.search('Initial commit on', st[2]) or re.search('No commits yet on', st[2]):
-            branch = st[2].split(' ')[-1]
-        elif re.search('no branch', st[2]):  # detached status
-            branch = get_tagname_or_hash()
-        elif len(st[2].strip().split('...')) == 1:
-            branch = st[2].strip()
+
+# ways to compute the status, each cheaper and less complete than the one before,
+# see GITSTATUS_BUDGET, and what they add to the `git status` command line
+STATUS_MODES = ('full', 'no-untracked', 'no-submodules', 'branch')
+STATUS_MODE_ARGS = {
+    'full': [],
+    'no-untracked': ['--untracked-files=no'],
+    'no-submodules': ['--untracked-files=no', '--ignore-submodules=all'],
+}
+
+
+@traced
+def get_status(cwd=None, git_common_dir=None, mode='full', aggregate=True):
+    """return the list of prompt fields for the repository at cwd, or None if not a repository
+
+    The first 10 fields are always present. Modes may append `key=value` fields
+    after them, e.g. `upstream=origin/master` in porcelain v2 mode, or
+    `mode=no-untracked` when computed in one of the cheaper STATUS_MODES.
+    With GITSTATUS_AGGREGATE, the counters of submodules and worktrees are
+    added unless aggregate is False, see gitaggregate.py.
+    """
+    args = list(STATUS_MODE_ARGS.get(mode, []))
+    kinds = set()
+    if os.environ.get('GITSTATUS_AGGREGATE') and mode != 'branch':
+        sys.modules.setdefault('gitstatus', sys.modules[__name__])  # don't import this file twice
+        import gitaggregate
+        kinds = gitaggregate.kinds()
+        if 'submodules' in kinds and mode in ('full', 'no-untracked'):
+            # their own status is computed concurrently, don't let git look into them one by one
+            args.append('--ignore-submodules=dirty')
+
+    status = None
+    if mode == 'full' and os.environ.get('GITSTATUS_BACKEND') == 'index' and not os.environ.get('GITSTATUS_LINES'):
+        # read the index and the worktree in-process, git only runs if that can't decide
+        sys.modules.setdefault('gitstatus', sys.modules[__name__])  # don't import this file twice
+        import gitindex
+        status = gitindex.get_status(cwd)
+    if status is not None:
+        pass
+    elif mode == 'branch':
+        status = get_status_branch(cwd, git_common_dir)
+    elif os.environ.get('GITSTATUS_PORCELAIN_V2'):
+        status = get_status_porcelain_v2(cwd, args)
+    else:
+        status = get_status_porcelain_v1(cwd, git_common_dir, args)
+    if status is not None and aggregate and kinds:
+        status = gitaggregate.aggregate(cwd, status, mode)
+    if status is not None and mode != 'full':
+        status.append('mode=%s' % mode)
+    return status
+
+
+def ahead_behind_limit():
+    """return GITSTATUS_AHEAD_BEHIND_LIMIT, 0 to let git count ahead/behind itself"""
+    return int(os.environ.get('GITSTATUS_AHEAD_BEHIND_LIMIT') or 0)
+
+
+def get_ahead_behind(cwd, head=None):
+    """return the bounded (ahead, behind) counts of HEAD against its upstream, see gitdivergence.py"""
+    sys.modules.setdefault('gitstatus', sys.modules[__name__])  # don't import this file twice
+    import gitdivergence
+    return gitdivergence.get_ahead_behind(cwd, ahead_behind_limit(), head)
+
+
+def get_line_counts(cwd, changes, truncated=False):
+    """return the `added=<n>` and `removed=<n>` fields for changes, see gitlines.py
+
+    With truncated, not every change was listed and the totals are shown as '<n>+'.
+    """
+    sys.modules.setdefault('gitstatus', sys.modules[__name__])  # don't import this file twice
+    import gitlines
+    found = find_repo(cwd or '.')
+    added, removed = gitlines.line_counts(found[0], changes) if found and changes else (0, 0)
+    suffix = '+' if truncated else ''
+    return ['added=%d%s' % (added, suffix), 'removed=%d%s' % (removed, suffix)]
+
+
+class Counts(object):
+    """counters for the entries of `git status`, in place of lists of the entries themselves
+
+    With a cap, counting stops as soon as one counter passes it and that counter is
+    reported as '<cap>+'. Counters of entries git had not printed yet are then low.
+    """
+    __slots__ = ('staged', 'conflicts', 'changed', 'untracked', 'deleted', 'cap', 'truncated')
+
+    def __init__(self, cap=0):
+        self.staged = self.conflicts = self.changed = self.untracked = self.deleted = 0
+        self.cap = cap
+        self.truncated = False
+
+    def add(self, x, y, step=1):
+        """count one entry from its XY code in porcelain v1 notation, return False past the cap
+
+        A step of -1 takes back an entry that was counted before.
+        """
+        if x == '?':
+            self.untracked += step
+            count = self.untracked
         else:
-            # current and remote branch info
-            branch, rest = st[2].strip().split('...')
-            if len(rest.split(' ')) == 1:
-                # remote_branch = rest.split(' ')[0]
-                pass
-            else:
-                # ahead or behind
-                divergence = ' '.join(rest.split(' ')[1:])
-                divergence = divergence.lstrip('[').rstrip(']')
-                for div in divergence.split(', '):
-                    if 'ahead' in div:
-                        ahead = int(div[len('ahead '):].strip())
-                    elif 'behind' in div:
-                        behind = int(div[len('behind '):].strip())
-    elif st[0] == '?' and st[1] == '?':
-        untracked.append(st)
+            count = 0
+            if y == 'M':
+                self.changed += step
+                count = self.changed
+            if y == 'D':
+                self.deleted += step
+                count = self.deleted
+            if x == 'U':
+                self.conflicts += step
+                count = max(count, self.conflicts)
+            elif x != ' ':
+                self.staged += step
+                count = max(count, self.staged)
+        if self.cap and count > self.cap:
+            self.truncated = True
+            return False
+        return True
+
+    def format(self, count):
+        if self.cap and count > self.cap:
+            return '%d+' % self.cap
+        return str(count)
+
+    @property
+    def clean(self):
+        return not (self.staged or self.conflicts or self.changed or self.untracked or self.deleted)
+
+
+def make_fields(branch, ahead, behind, counts, stashed):
+    return [
+        branch,
+        str(ahead),
+        str(behind),
+        counts.format(counts.staged),
+        counts.format(counts.conflicts),
+        counts.format(counts.changed),
+        counts.format(counts.untracked),
+        str(stashed),
+        str(int(counts.clean)),
+        counts.format(counts.deleted)
+    ]
+
+
+def read_records(stream, sep, chunk_size=65536):
+    """yield the sep-terminated records of a binary stream as they arrive"""
+    text_sep = sep.decode()
+    tail = b''
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            break
+        chunk = tail + chunk
+        end = chunk.rfind(sep)
+        if end < 0:
+            tail = chunk
+            continue
+        # sep is ASCII, so it never splits a multi-byte character
+        tail = chunk[end + 1:]
+        for record in chunk[:end].decode('utf-8', 'surrogateescape').split(text_sep):
+            yield record
+    if tail:
+        yield tail.decode('utf-8', 'surrogateescape')
+
+
+def run_status(args, cwd, sep, headers, parse):
+    """run `git status <args>`, feed its records to parse and count the entries it yields
+
+    Returns the Counts, or None if git failed (e.g. not a git repository). Stops
+    reading and kills git once the GITSTATUS_MAX_COUNT cap is passed.
+    """
+    from subprocess import Popen, PIPE, DEVNULL
+
+    counts = Counts(int(os.environ.get('GITSTATUS_MAX_COUNT') or 0))
+    with Span('process', ' '.join(['git', 'status'] + args)):
+        po = Popen(['git', 'status'] + args, env=dict(os.environ, LANG="C"), stdout=PIPE, stderr=DEVNULL, cwd=cwd)
+        with po:
+            try:
+                for x, y in parse(read_records(po.stdout, sep), headers):
+                    if not counts.add(x, y):
+                        po.kill()
+                        break
+            except BaseException:  # e.g. GITSTATUS_TIMEOUT, don't wait for git to finish
+                po.kill()
+                raise
+    if po.returncode != 0 and not counts.truncated:
+        return None  # Not a git repository
+    return counts
+
+
+def parse_porcelain_v2(records, headers):
+    """parse the records of `git status --porcelain=v2 --branch --show-stash -z`
+
+    Fills headers with the header names (`branch.oid`, `branch.head`, `branch.upstream`,
+    `branch.ab`, `stash`) and their values, and yields the XY code of every entry in
+    porcelain v1 notation ('.' is ' ', untracked is '??'). If headers has a 'changes'
+    list, the (path, index mode, index oid) of the files modified or deleted in the
+    worktree are appended to it, see gitlines.py.
+    """
+    records = iter(records)
+    changes = headers.get('changes')
+    for record in records:
+        kind = record[:1]
+        if kind == '#':
+            key, _, value = record[2:].partition(' ')
+            headers[key] = value
+        elif kind == '1' or kind == 'u':
+            if changes is not None and kind == '1' and record[3] in 'MTD' and record[5] == 'N':
+                fields = record.split(' ', 8)
+                changes.append((fields[8], fields[4], fields[7]))
+            yield record[2:4].replace('.', ' ')
+        elif kind == '2':
+            if changes is not None and record[3] in 'MTD' and record[5] == 'N':
+                fields = record.split(' ', 9)
+                changes.append((fields[9], fields[4], fields[7]))
+            yield record[2:4].replace('.', ' ')
+            next(records, None)  # the original path of a rename or copy is a separate record
+        elif kind == '?':
+            yield '??'
+
+
+def get_status_porcelain_v2(cwd=None, extra_args=()):
+    """collect every field from a single `git status --porcelain=v2` call (requires git 2.35+)"""
+    headers = {'changes': []} if os.environ.get('GITSTATUS_LINES') else {}
+    args = ['--porcelain=v2', '--branch', '--show-stash', '-z'] + list(extra_args)
+    if ahead_behind_limit():
+        args.append('--no-ahead-behind')
+    counts = run_status(args, cwd, b'\0', headers, parse_porcelain_v2)
+    if counts is None:
+        return None
+    fields = make_fields_v2(headers, counts, cwd)
+    if 'changes' in headers:
+        fields.extend(get_line_counts(cwd, headers['changes'], counts.truncated))
+    return fields
+
+
+def make_fields_v2(headers, counts, cwd=None):
+    """return the prompt fields for the headers of a porcelain v2 status and its counts
+
+    The line is the one get_status_porcelain_v1 would give unless GITSTATUS_PORCELAIN_V2
+    is set, which adds the upstream, so that gitwatch.Watcher prints the same either way.
+    """
+    branch = headers.get('branch.head', '')
+    if branch == '(detached)':
+        branch = get_tagname_or_hash(cwd, headers.get('branch.oid'))
+
+    ahead, behind = 0, 0
+    if headers.get('branch.ab') == '+? -?':  # --no-ahead-behind, and the branches differ
+        ahead, behind = get_ahead_behind(cwd, headers.get('branch.oid'))
+    elif 'branch.ab' in headers:
+        ahead, behind = headers['branch.ab'].split(' ')
+        ahead, behind = int(ahead), -int(behind)
+
+    fields = make_fields(branch, ahead, behind, counts, int(headers.get('stash', 0)))
+    if os.environ.get('GITSTATUS_PORCELAIN_V2'):
+        fields.append('upstream=%s' % headers.get('branch.upstream', ''))
+    return fields
+
+
+def parse_porcelain_v1(lines, headers):
+    """parse the lines of `git status --porcelain --branch`
+
+    Stores the `## ` branch line in headers['branch'] and yields the XY code of every entry.
+    If headers has a 'changes' list, the (path, None, None) of the files modified or
+    deleted in the worktree are appended to it, see gitlines.py.
+    """
+    changes = headers.get('changes')
+    for line in lines:
+        if line[:2] == '##':
+            headers['branch'] = line[2:]
+        else:
+            if changes is not None and line[1] in 'MTD' and line[0] != 'U' and line[:2] != 'DD':
+                changes.append((_path_v1(line), None, None))
+            yield line[:2]
+
+
+def _path_v1(line):
+    """return the (new) path of a `git status --porcelain` entry, unquoted"""
+    path = line[3:]
+    if line[0] in 'RC':
+        path = path[path.rindex(' -> ') + 4:]
+    if path[:1] == '"':
+        import codecs
+        path = codecs.escape_decode(path[1:-1].encode('utf-8', 'surrogateescape'))[0]
+        path = path.decode('utf-8', 'surrogateescape')
+    return path
+
+
+def get_status_porcelain_v1(cwd=None, git_common_dir=None, extra_args=()):
+    # `git status --porcelain --branch` can collect all information
+    # branch, remote_branch, untracked, staged, changed, conflicts, ahead, behind
+    headers = {'changes': []} if os.environ.get('GITSTATUS_LINES') else {}
+    args = ['--porcelain', '--branch'] + list(extra_args)
+    if ahead_behind_limit():
+        args.append('--no-ahead-behind')
+    counts = run_status(args, cwd, b'\n', headers, parse_porcelain_v1)
+    if counts is None:
+        return None
+
+    # collect git status information
+    ahead, behind = 0, 0
+    st = headers.get('branch', '')
+    if 'Initial commit on' in st or 'No commits yet on' in st:
+        branch = st.split(' ')[-1]
+    elif 'no branch' in st:  # detached status
+        branch = get_tagname_or_hash(cwd)
+    elif len(st.strip().split('...')) == 1:
+        branch = st.strip()
     else:
-        if st[1] == 'M':
-            changed.append(st)
-        if st[1] == 'D':
-            deleted.append(st)
-        if st[0] == 'U':
-            conflicts.append(st)
-        elif st[0] != ' ':
-            staged.append(st)
-
-stashed = get_stash()
-if not changed and not deleted and not staged and not conflicts and not untracked:
-    clean = 1
-else:
-    clean = 0
-
-out = ' '.join([
-    branch,
-    str(ahead),
-    str(behind),
-    str(len(staged)),
-    str(len(conflicts)),
-    str(len(changed)),
-    str(len(untracked)),
-    str(stashed),
-    str(clean),
-    str(len(deleted))
-])
-print(out, end='')
+        # current and remote branch info
+        branch, rest = st.strip().split('...')
+        if len(rest.split(' ')) == 1:
+            # remote_branch = rest.split(' ')[0]
+            pass
+        else:
+            # ahead or behind
+            divergence = ' '.join(rest.split(' ')[1:])
+            divergence = divergence.lstrip('[').rstrip(']')
+            if divergence == 'different':  # --no-ahead-behind
+                ahead, behind = get_ahead_behind(cwd)
+            for div in divergence.split(', '):
+                if 'ahead' in div:
+                    ahead = int(div[len('ahead '):].strip())
+                elif 'behind' in div:
+                    behind = int(div[len('behind '):].strip())
+
+    stashed = get_stash(cwd, git_common_dir)
+    fields = make_fields(branch, ahead, behind, counts, stashed)
+    if 'changes' in headers:
+        fields.extend(get_line_counts(cwd, headers['changes'], counts.truncated))
+    return fields
+
+
+def get_status_branch(cwd=None, git_common_dir=None):
+    """return the prompt fields without reading the index or the worktree
+
+    Only the branch, ahead/behind and the stash are filled in, the other counters
+    are 0 and the repository is never reported as clean.
+    """
+    from subprocess import check_output, CalledProcessError, DEVNULL
+
+    args = ['git', 'symbolic-ref', '--short', '-q', 'HEAD']
+    try:
+        with Span('process', ' '.join(args)):
+            branch = check_output(args, cwd=cwd, stderr=DEVNULL).decode('utf-8').strip()
+    except CalledProcessError as e:
+        if e.returncode != 1:
+            return None  # Not a git repository
+        branch = get_tagname_or_hash(cwd)  # detached
+
+    ahead, behind = 0, 0
+    if ahead_behind_limit():
+        ahead, behind = get_ahead_behind(cwd)
+    else:
+        args = ['git', 'rev-list', '--left-right', '--count', 'HEAD...@{upstream}']
+        try:
+            with Span('process', ' '.join(args)):
+                ahead, behind = check_output(args, cwd=cwd, stderr=DEVNULL).decode('utf-8').split()
+        except CalledProcessError:
+            pass  # no upstream, or no commits yet
+
+    fields = make_fields(branch, ahead, behind, Counts(), get_stash(cwd, git_common_dir))
+    fields[8] = '0'  # clean, as far as we know
+    return fields
+
+# environment variables that change the output of gitstatus.py, and so its cache key
+MODE_VARIABLES = ('GITSTATUS_PORCELAIN_V2', 'GITSTATUS_MAX_COUNT', 'GITSTATUS_AHEAD_BEHIND_LIMIT', 'GITSTATUS_LINES',
+                  'GITSTATUS_AGGREGATE', 'GITSTATUS_BACKEND')
+
+
+def cache_dir():
+    return os.environ.get('GITSTATUS_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'gitstatus')
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return '-'
+    return '%d:%d' % (st.st_mtime_ns, st.st_size)
+
+
+def _upstream_ref(common_dir, branch):
+    """return the remote-tracking ref of branch as set by branch.<branch>.remote and .merge, or None
+
+    Assumes the default fetch refspec, refs/heads/* to refs/remotes/<remote>/*. The
+    config file itself is part of the fingerprint, so a changed upstream is noticed anyway.
+    """
+    section = '[branch "%s"]' % branch
+    inside, remote, merge = False, None, None
+    try:
+        with open(os.path.join(common_dir, 'config')) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('['):
+                    inside = line == section
+                elif inside:
+                    key, _, value = line.partition('=')
+                    key = key.strip().lower()
+                    if key == 'remote':
+                        remote = value.strip()
+                    elif key == 'merge':
+                        merge = value.strip()
+    except IOError:
+        return None
+    if not remote or not merge or not merge.startswith('refs/heads/'):
+        return None
+    if remote == '.':
+        return merge
+    return 'refs/remotes/%s/%s' % (remote, merge[len('refs/heads/'):])
+
+
+@traced
+def get_fingerprint(root, git_dir, common_dir, aggregate=True):
+    """return a string that changes whenever the status of the repository may have changed
+
+    It covers the index, HEAD and the ref it points to, its upstream (the remote-tracking
+    ref and the config that names it, for ahead/behind), the stash log and the mtimes of
+    the worktree root and its top-level directories, which change when files are added
+    or removed there. Edits to files that are already tracked are only noticed once they
+    reach the index, set GITSTATUS_CACHE_TTL to bound how long such changes can go unseen.
+    Only stat() calls are made, so that checking costs next to nothing next to `git status`.
+    With GITSTATUS_AGGREGATE, the same goes for the submodules and worktrees added unless
+    aggregate is False, see gitaggregate.fingerprint. Returns None when it can't tell.
+    """
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except IOError:
+        return None
+
+    parts = [':'.join(os.environ.get(name, '') for name in MODE_VARIABLES), head]
+    if head.startswith('ref: '):
+        parts.append(_stat_key(os.path.join(common_dir, head[len('ref: '):])))
+    if head.startswith('ref: refs/heads/'):
+        upstream = _upstream_ref(common_dir, head[len('ref: refs/heads/'):])
+        if upstream:
+            parts.append(_stat_key(os.path.join(common_dir, upstream)))
+    for path in (os.path.join(git_dir, 'index'),
+                 os.path.join(common_dir, 'config'),
+                 os.path.join(git_dir, 'MERGE_HEAD'),
+                 os.path.join(common_dir, 'packed-refs'),
+                 os.path.join(common_dir, 'FETCH_HEAD'),
+                 os.path.join(common_dir, 'logs', 'refs', 'stash'),
+                 root):
+        parts.append(_stat_key(path))
+    try:
+        for entry in os.scandir(root):
+            if entry.name != '.git' and entry.is_dir(follow_symlinks=False):
+                parts.append('%d' % entry.stat(follow_symlinks=False).st_mtime_ns)
+    except OSError:
+        return None
+    if aggregate and os.environ.get('GITSTATUS_AGGREGATE'):
+        sys.modules.setdefault('gitstatus', sys.modules[__name__])  # don't import this file twice
+        import gitaggregate
+        others = gitaggregate.fingerprint(git_dir, common_dir)
+        if others is None:
+            return None
+        parts.append(others)
+    return ' '.join(parts)
+
+
+def _cache_file(root):
+    # one file per repository, named after its path the way vim names undo files
+    return os.path.join(cache_dir(), root.replace(os.sep, '%'))
+
+
+@traced
+def read_cache(root, fingerprint):
+    """return the cached status line of root if it was stored with fingerprint, else None"""
+    path = _cache_file(root)
+    try:
+        with open(path) as f:
+            cached_fingerprint = f.readline().rstrip('\n')
+            written = float(f.readline())
+            line = f.read()
+    except (IOError, ValueError):
+        return None
+
+    ttl = float(os.environ.get('GITSTATUS_CACHE_TTL') or 0)
+    try:
+        if cached_fingerprint != fingerprint or (ttl and time.time() - written > ttl):
+            os.unlink(path)
+            return None
+        os.utime(path)  # mark as recently used
+    except OSError:
+        pass
+    return line
+
+
+def write_file(path, text):
+    """replace the file at path with text at once, then evict() its directory
+
+    Failures are ignored, whatever is written this way is only an optimization.
+    """
+    directory = os.path.dirname(path)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+        evict(directory)
+    except (IOError, OSError):
+        pass
+
+
+@traced
+def write_cache(root, fingerprint, line):
+    """store line for root and evict the least recently used repositories over GITSTATUS_CACHE_SIZE"""
+    write_file(_cache_file(root), '%s\n%f\n%s' % (fingerprint, time.time(), line))
+
+
+def evict(directory):
+    """remove the least recently used files of directory over GITSTATUS_CACHE_SIZE"""
+    size = int(os.environ.get('GITSTATUS_CACHE_SIZE') or 256)
+    entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+    if len(entries) > size:
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in entries[:len(entries) - size]:
+            os.unlink(entry.path)
+
+
+def _mode_file(root):
+    return os.path.join(cache_dir(), 'modes', root.replace(os.sep, '%'))
+
+
+def read_mode(root):
+    """return the mode, smoothed latency (ms) and last re-check time recorded for root, see GITSTATUS_BUDGET"""
+    try:
+        with open(_mode_file(root)) as f:
+            mode, latency, checked = f.read().split()
+        if mode in STATUS_MODES:
+            return mode, float(latency), float(checked)
+    except (IOError, ValueError):
+        pass
+    return 'full', 0.0, 0.0
+
+
+def write_mode(root, mode, latency, checked):
+    write_file(_mode_file(root), '%s %.1f %d\n' % (mode, latency, checked))
+
+
+def adapt_mode(root, mode, elapsed, budget):
+    """record that computing the status of root in mode took elapsed ms, degrading it past budget
+
+    In a degraded mode, every GITSTATUS_RECHECK_INTERVAL seconds (default 600) a
+    background run of gitstatus.py times the next better mode, see recheck_mode().
+    """
+    recorded, latency, checked = read_mode(root)
+    latency = elapsed if recorded != mode or not latency else (latency + elapsed) / 2
+    now = time.time()
+    if latency > budget and mode != STATUS_MODES[-1]:
+        mode, latency, checked = STATUS_MODES[STATUS_MODES.index(mode) + 1], 0.0, now
+    elif mode != 'full' and now - checked > float(os.environ.get('GITSTATUS_RECHECK_INTERVAL') or 600):
+        start_recheck(root, budget)
+        checked = now
+    write_mode(root, mode, latency, checked)
+
+
+def start_recheck(root, budget):
+    from subprocess import Popen, DEVNULL
+
+    env = dict(os.environ, GITSTATUS_RECHECK='1', GITSTATUS_TIMEOUT='%f' % (2 * budget / 1000.0))
+    env.pop('GITSTATUS_TRACE', None)
+    Popen([sys.executable, os.path.abspath(__file__)], cwd=root, env=env,
+          stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+
+
+def recheck_mode(root, budget):
+    """time the mode before the one recorded for root and go back to it if it fits the budget"""
+    mode, latency, checked = read_mode(root)
+    if mode == 'full':
+        return
+    better = STATUS_MODES[STATUS_MODES.index(mode) - 1]
+    start = time.perf_counter()
+    get_status(root, mode=better)
+    elapsed = (time.perf_counter() - start) * 1000
+    if elapsed <= budget:
+        write_mode(root, better, elapsed, checked)
+
+
+def main():
+    global _trace, _trace_start
+    if os.environ.get('GITSTATUS_TRACE'):
+        _trace, _trace_start = [], time.perf_counter()
+        started = time.time()
+
+    timeout = float(os.environ.get('GITSTATUS_TIMEOUT') or 0)
+    if timeout:
+        import signal
+
+        def on_timeout(signum, frame):
+            raise TimeoutError()
+        signal.signal(signal.SIGALRM, on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    result = 'error'
+    try:
+        result = 'ok' if print_status() else 'none'
+    except TimeoutError:
+        result = 'timeout'
+        return 1
+    finally:
+        if _trace is not None:
+            write_trace(started, result)
+    return 0
+
+
+def write_trace(started, result):
+    """append the record of this run to the GITSTATUS_TRACE file as one line of JSON
+
+    startup_ms is the time between GITSTATUS_T0 (a Unix time in seconds, set by the caller
+    right before starting gitstatus.py) and main(), i.e. mostly interpreter startup.
+    """
+    import json
+
+    record = {
+        'time': started,
+        'pid': os.getpid(),
+        'cwd': os.getcwd(),
+        'result': result,
+        'wall_ms': round((time.perf_counter() - _trace_start) * 1000, 3),
+        'cpu_ms': round(time.process_time() * 1000, 3),
+        'children_cpu_ms': round(_cpu_time('process') * 1000, 3),
+        'spans': _trace,
+    }
+    try:
+        record['startup_ms'] = round((started - float(os.environ['GITSTATUS_T0'])) * 1000, 3)
+    except (KeyError, ValueError):
+        pass
+    try:
+        with open(os.environ['GITSTATUS_TRACE'], 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    except (IOError, OSError):
+        pass  # tracing must never break the prompt
+
+
+# names of the fixed fields of a status line, in order
+FIELDS = ('branch', 'ahead', 'behind', 'staged', 'conflicts', 'changed', 'untracked', 'stashed', 'clean', 'deleted')
+
+
+class Status(object):
+    """the status of a repository, as gitstatus.py prints it
+
+    Counters are ints. Those named in capped are lower bounds, printed as '<n>+'
+    (see GITSTATUS_MAX_COUNT and GITSTATUS_AHEAD_BEHIND_LIMIT). extra holds the
+    `key=value` fields after the first 10, in order. str() gives the status line.
+    """
+    __slots__ = FIELDS + ('extra', 'capped')
+
+    def __init__(self, branch, ahead=0, behind=0, staged=0, conflicts=0, changed=0, untracked=0, stashed=0,
+                 clean=False, deleted=0, extra=None, capped=frozenset()):
+        self.branch = branch
+        self.ahead, self.behind = ahead, behind
+        self.staged, self.conflicts, self.changed, self.untracked = staged, conflicts, changed, untracked
+        self.stashed = stashed
+        self.clean = clean
+        self.deleted = deleted
+        self.extra = extra if extra is not None else {}
+        self.capped = frozenset(capped)
+
+    @classmethod
+    def from_fields(cls, fields):
+        """return the Status of a list of fields as returned by get_status()"""
+        values = {'branch': fields[0]}
+        capped = set()
+        for name, value in zip(FIELDS[1:], fields[1:len(FIELDS)]):
+            if value.endswith('+'):
+                capped.add(name)
+            values[name] = int(value.rstrip('+'))
+        values['clean'] = bool(values['clean'])
+        extra = dict(field.partition('=')[::2] for field in fields[len(FIELDS):])
+        return cls(extra=extra, capped=capped, **values)
+
+    def fields(self):
+        """return the fields of the status line"""
+        fields = [self.branch]
+        for name in FIELDS[1:]:
+            fields.append('%d%s' % (getattr(self, name), '+' if name in self.capped else ''))
+        fields.extend('%s=%s' % item for item in self.extra.items())
+        return fields
+
+    def __str__(self):
+        return ' '.join(self.fields())
+
+    def __repr__(self):
+        return 'Status(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Status) and self.fields() == other.fields()
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class GitStatus(object):
+    """the status of the repository containing path, for callers that ask again and again
+
+        repo = GitStatus('~/src/dotfiles')
+        status = repo.refresh()  # a Status, or None outside a repository
+        print(status.branch, status.changed)
+
+    Keeps the repository location and the last Status. With watch (Linux only),
+    inotify tells which paths changed and only those are rechecked, see
+    gitwatch.Watcher. With cache, refresh() only runs git again once the
+    fingerprint changed (see get_fingerprint), i.e. once the index, HEAD, a ref
+    or the upstream did, as with GITSTATUS_CACHE: cheap, but edits to tracked
+    files go unseen until staged or GITSTATUS_CACHE_TTL expires. Otherwise git
+    runs on every call. The GITSTATUS_* variables apply as on the command line.
+    """
+
+    def __init__(self, path='.', watch=False, cache=False):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.repo = find_repo(self.path)
+        self.cache = cache
+        self.status = None
+        self.fingerprint = None
+        self.fingerprint_time = 0.0
+        self.watcher = None
+        if watch and self.repo:
+            sys.modules.setdefault('gitstatus', sys.modules[__name__])  # don't import this file twice
+            try:
+                import gitwatch
+                self.watcher = gitwatch.Watcher(*self.repo)
+            except (ImportError, OSError, AttributeError):
+                pass  # no inotify here
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def refresh(self, force=False):
+        """return the current Status, or None if path is not in a repository
+
+        Returns the last one as long as the fingerprint didn't change, for at
+        most GITSTATUS_CACHE_TTL seconds if set, unless force. With
+        GITSTATUS_CACHE it is also looked up in and stored to the cache files
+        shared with other processes. With GITSTATUS_BUDGET=<ms>, repositories
+        whose status takes longer than that are switched to the next cheaper
+        of the STATUS_MODES, and back once a background re-check finds the
+        better mode affordable again.
+        """
+        if self.watcher is not None:
+            try:
+                fields = self.watcher.status()
+            except OSError:  # e.g. out of inotify watches, stop watching this repository
+                self.close()
+            else:
+                self.status = Status.from_fields(fields) if fields else None
+                return self.status
+
+        root = self.repo[0] if self.repo else None
+        budget = float(os.environ.get('GITSTATUS_BUDGET') or 0)
+        mode = read_mode(root)[0] if root and budget else 'full'
+        shared = bool(os.environ.get('GITSTATUS_CACHE'))
+        fingerprint = get_fingerprint(*self.repo) if self.repo and (self.cache or shared) else None
+        if fingerprint:
+            fingerprint += ' ' + mode
+            ttl = float(os.environ.get('GITSTATUS_CACHE_TTL') or 0)
+            if not force and fingerprint == self.fingerprint and not (ttl and time.time() - self.fingerprint_time > ttl):
+                return self.status
+
+        line = read_cache(root, fingerprint) if fingerprint and shared and not force else None
+        if line is not None:
+            fields = line.split(' ')
+        else:
+            start = time.perf_counter()
+            try:
+                fields = get_status(self.path, self.repo[2] if self.repo else None, mode)
+            finally:  # timing out (GITSTATUS_TIMEOUT) is the most expensive outcome of all
+                if root and budget:
+                    adapt_mode(root, mode, (time.perf_counter() - start) * 1000, budget)
+            if fields is not None and fingerprint and shared:
+                write_cache(root, fingerprint, ' '.join(fields))
+        self.status = Status.from_fields(fields) if fields is not None else None
+        self.fingerprint, self.fingerprint_time = fingerprint, time.time()
+        return self.status
+
+
+def get_status_line(cwd=None):
+    """return the status line printed for the repository at cwd, see GitStatus.refresh()"""
+    budget = float(os.environ.get('GITSTATUS_BUDGET') or 0)
+    if budget and os.environ.get('GITSTATUS_RECHECK'):
+        repo = find_repo(cwd or '.')
+        if repo:
+            recheck_mode(repo[0], budget)
+        return None
+    status = GitStatus(cwd or '.', cache=False).refresh()
+    return str(status) if status is not None else None
+
+
+def print_status():
+    line = get_status_line()
+    if line is not None:
+        print(line, end='')
+    return line is not None
+
+
+if __name__ == '__main__':
+    sys.exit(main())
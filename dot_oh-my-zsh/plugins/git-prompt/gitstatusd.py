@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""Long-lived gitstatus server for the git-prompt plugin.
+
+Listens on a Unix socket and answers one request per line:
+
+    status <path>
+
+with the same space-separated line `gitstatus.py` prints, or an empty line
+if <path> is not inside a git repository. Repositories are keyed by their
+worktree root so that per-repo state (git dirs, locks) stays warm between
+prompts and no interpreter has to be started for each of them.
+
+    fsmonitor <token> <path>
+
+is sent by the fsmonitor hook (gitfsmonitor.py) and answered with the hook's
+output, a new token and the paths changed since <token>, all NUL-terminated,
+followed by one more NUL. A lone NUL means the hook should fail.
+"""
+from __future__ import print_function
+
+import os
+import signal
+import sys
+import socket
+import socketserver
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gitstatus
+
+
+def default_socket_path():
+    """return the socket path shared with git-prompt.plugin.zsh
+
+    The socket goes in a directory of its own that serve() creates with mode 0700,
+    since the runtime directory may be a shared /tmp.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(runtime_dir, 'gitstatusd-%d' % os.getuid(), 'socket')
+
+
+def is_private(path):
+    """return True if path belongs to this user and nobody else can write to it"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+class Repo(object):
+    """per-repository state kept between requests"""
+
+    def __init__(self, root, git_dir=None, common_dir=None):
+        self.root = root
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        # last result and what it was computed from, see GITSTATUS_CACHE and GITSTATUS_WATCH
+        self.state = gitstatus.GitStatus(root, watch=bool(git_dir and os.environ.get('GITSTATUS_WATCH')),
+                                         cache=bool(git_dir and os.environ.get('GITSTATUS_CACHE')))
+        # fsmonitor queries come from the `git status` run under self.lock, so they
+        # can't wait for it
+        self.journal = None
+        self.journal_lock = threading.Lock()
+        self.install_fsmonitor = bool(git_dir and os.environ.get('GITSTATUS_FSMONITOR'))
+
+    def close(self):
+        self.state.close()
+        with self.journal_lock:
+            if self.journal:
+                self.journal.close()
+
+    def fsmonitor(self, token):
+        """return the output of the fsmonitor hook for token, empty if it should fail"""
+        with self.journal_lock:
+            if self.journal is None:
+                try:
+                    import gitwatch
+                    self.journal = gitwatch.Journal(self.root)
+                except (ImportError, OSError, AttributeError):
+                    self.journal = False  # no inotify here
+            if not self.journal:
+                return b''
+            try:
+                token, paths = self.journal.since(token)
+            except (OSError, AttributeError):  # e.g. out of inotify watches, let git check everything itself
+                self.journal.close()
+                self.journal = False
+                return b''
+        return b''.join(os.fsencode(path) + b'\0' for path in [token] + (paths if paths is not None else ['/']))
+
+    def status(self):
+        """return the gitstatus.Status of the repository, or None"""
+        # serialize requests per repository, concurrent prompts in the same
+        # repo would only race each other for the index lock
+        with self.lock:
+            self.last_used = time.time()
+            if self.install_fsmonitor:
+                # not while get_repo() holds repos_lock, git may already query the hook
+                import gitfsmonitor
+                gitfsmonitor.install(self.root)
+                self.install_fsmonitor = False
+            return self.state.refresh()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, idle_timeout=3600, max_repos=256):
+        self.repos = {}
+        self.repos_lock = threading.Lock()
+        self.idle_timeout = idle_timeout
+        self.max_repos = max_repos
+        self.last_request = time.time()
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+
+    def get_repo(self, path):
+        found = gitstatus.find_repo(path)
+        if found is None:
+            # let git decide, e.g. for $GIT_DIR setups or bare repositories
+            root, git_dir, common_dir = os.path.abspath(path), None, None
+        else:
+            root, git_dir, common_dir = found
+        with self.repos_lock:
+            repo = self.repos.get(root)
+            if repo is None:
+                if len(self.repos) >= self.max_repos:
+                    oldest = min(self.repos.values(), key=lambda r: r.last_used)
+                    del self.repos[oldest.root]
+                    oldest.close()
+                repo = self.repos[root] = Repo(root, git_dir, common_dir)
+            return repo
+
+    def status(self, path):
+        self.last_request = time.time()
+        status = self.get_repo(path).status()
+        return str(status) if status is not None else ''
+
+    def fsmonitor(self, path, token):
+        self.last_request = time.time()
+        return self.get_repo(path).fsmonitor(token)
+
+    def watch_idle(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 60))
+            if time.time() - self.last_request > self.idle_timeout:
+                self.shutdown()
+                return
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command, _, arg = line.decode('utf-8', 'surrogateescape').rstrip('\n').partition(' ')
+            if command == 'fsmonitor':
+                token, _, path = arg.partition(' ')
+                try:
+                    reply = self.server.fsmonitor(path, token)
+                except Exception:
+                    reply = b''
+                self.wfile.write(reply + b'\0')
+                self.wfile.flush()
+                continue
+            if command == 'status':
+                try:
+                    reply = self.server.status(arg)
+                except Exception:  # never take the server down because of one repository
+                    reply = ''
+            else:
+                reply = ''
+            self.wfile.write((reply + '\n').encode('utf-8', 'surrogateescape'))
+            self.wfile.flush()
+
+
+def is_alive(path):
+    """return True if a server is already listening on path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def serve(path, idle_timeout):
+    # another user could otherwise put their own server (or socket) in our place
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return 1
+    if not is_private(directory):
+        return 1
+    if os.path.lexists(path):
+        if not is_private(path):
+            return 1
+        if is_alive(path):
+            return 0
+        os.unlink(path)  # left behind by a server that died
+
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(path, idle_timeout)
+    except socket.error:
+        return 0 if is_alive(path) else 1  # lost the race against another shell
+    finally:
+        os.umask(old_umask)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watcher = threading.Thread(target=server.watch_idle)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve git prompt status over a Unix socket.", prog="gitstatusd")
+    parser.add_argument('--socket', default=default_socket_path(), help="socket path (default: %(default)s)")
+    parser.add_argument('--idle-timeout', type=int, default=int(os.environ.get('GITSTATUS_DAEMON_IDLE_TIMEOUT', 3600)),
+                        help="exit after this many seconds without requests (default: %(default)s)")
+    args = parser.parse_args()
+    sys.exit(serve(args.socket, args.idle_timeout))
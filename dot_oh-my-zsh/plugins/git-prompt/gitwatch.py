@@ -0,0 +1,395 @@
+"""inotify-driven incremental status tracking for the git-prompt plugin.
+
+A Watcher subscribes to every directory of a worktree and to its git directory.
+Between two prompts the kernel queues the paths that changed; when the status is
+requested only those paths are handed to `git status`, so the cost follows the
+size of the change instead of the size of the repository. The whole tree is
+only rescanned when the watcher starts, when something changes in the git
+directory (index, HEAD, refs, info/exclude) or in a .gitignore, or when the
+kernel event queue overflows.
+
+A Journal watches the same directories to answer git's fsmonitor hook
+(gitfsmonitor.py) instead: which paths changed since a given token.
+
+Used by gitstatusd.py when GITSTATUS_WATCH is set, and for fsmonitor queries.
+Linux only.
+"""
+import ctypes
+import errno
+import os
+import struct
+import time
+
+import gitstatus
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WORKTREE_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                 IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+GIT_DIR_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """minimal ctypes binding of the inotify API"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        """return the watch descriptor for path, or -1 if it disappeared in the meantime"""
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return -1
+            raise OSError(err, os.strerror(err), path)  # e.g. ENOSPC, out of watches
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        """yield (wd, mask, name) for every queued event without blocking"""
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+def parse_porcelain_v2_paths(records, headers):
+    """like gitstatus.parse_porcelain_v2, but yield (path, XY) and ignored entries ('!!')"""
+    records = iter(records)
+    for record in records:
+        kind = record[:1]
+        if kind == '#':
+            key, _, value = record[2:].partition(' ')
+            headers[key] = value
+        elif kind == '1':
+            yield record.split(' ', 8)[8], record[2:4].replace('.', ' ')
+        elif kind == '2':
+            yield record.split(' ', 9)[9], record[2:4].replace('.', ' ')
+            next(records, None)
+        elif kind == 'u':
+            yield record.split(' ', 10)[10], record[2:4].replace('.', ' ')
+        elif kind == '?':
+            yield record[2:], '??'
+        elif kind == '!':
+            yield record[2:], '!!'
+
+
+class Tree(object):
+    """inotify watches on every directory of a worktree, but its .git"""
+
+    ignored = frozenset()  # relative directories not to watch, with or without a trailing '/'
+
+    def __init__(self, root):
+        self.root = root
+        self.inotify = None
+        self.wds = {}   # relative directory -> watch descriptor
+        self.dirs = {}  # watch descriptor -> relative directory, '' is the root
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def _open(self):
+        # start over without any watch
+        self.close()
+        self.inotify = Inotify()
+        self.wds = {}
+        self.dirs = {}
+
+    def _watch_tree(self, rel):
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            if rel in self.ignored or rel + '/' in self.ignored:
+                continue
+            path = os.path.join(self.root, rel) if rel else self.root
+            wd = self.inotify.add_watch(path, WORKTREE_MASK)
+            if wd < 0:
+                continue
+            self.wds[rel] = wd
+            self.dirs[wd] = rel
+            try:
+                for entry in os.scandir(path):
+                    if entry.is_dir(follow_symlinks=False) and not (rel == '' and entry.name == '.git'):
+                        stack.append(rel + '/' + entry.name if rel else entry.name)
+            except OSError:
+                pass
+
+    def _unwatch_tree(self, rel):
+        prefix = rel + '/'
+        for directory in [d for d in self.wds if d == rel or d.startswith(prefix)]:
+            wd = self.wds.pop(directory)
+            self.dirs.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+
+class Watcher(Tree):
+    """keeps the status counters of one worktree current from inotify events"""
+
+    # rechecking more paths than this at once is not cheaper than a full scan
+    MAX_PATHSPECS = 1000
+
+    def __init__(self, root, git_dir, common_dir):
+        Tree.__init__(self, root)
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self.rescan_needed = True
+
+    def status(self):
+        """return the prompt fields, rechecking only the paths that changed since the last call"""
+        if self.inotify is not None:
+            self._drain()
+        if self.rescan_needed or len(self.dirty) > self.MAX_PATHSPECS:
+            return self._rescan()
+        if self.dirty:
+            self._recheck(self.dirty)
+            self.dirty = set()
+        return self._fields()
+
+    def _fields(self):
+        fields = gitstatus.make_fields_v2(self.headers, self.counts, self.root)
+        if os.environ.get('GITSTATUS_LINES'):
+            changes = [(path, None, None) for path, xy in self.entries.items()
+                       if xy[1] in 'MTD' and xy[0] != 'U' and xy != 'DD']
+            fields.extend(gitstatus.get_line_counts(self.root, changes))
+        return fields
+
+    def _rescan(self):
+        self._open()
+        self.git_wds = set()
+        self.entries = {}  # relative path -> XY code of every entry git reported
+        self.dirty = set()
+        self.headers = {}
+        self.counts = gitstatus.Counts()
+        self.rescan_needed = False
+
+        # HEAD, index, packed-refs, FETCH_HEAD, info/exclude and loose refs and their logs (e.g. the stash)
+        git_dirs = [self.git_dir, self.common_dir, os.path.join(self.git_dir, 'logs'),
+                    os.path.join(self.common_dir, 'info')]
+        for top in (os.path.join(self.common_dir, 'refs'), os.path.join(self.common_dir, 'logs', 'refs')):
+            git_dirs.extend(directory for directory, _, _ in os.walk(top))
+        for directory in set(git_dirs):
+            wd = self.inotify.add_watch(directory, GIT_DIR_MASK)
+            if wd >= 0:
+                self.git_wds.add(wd)
+
+        # watch before scanning, so that nothing changing during the scan is lost,
+        # skipping the directories the previous scan found to be ignored
+        self.tracked_dirs = self._tracked_dirs()
+        self._watch_tree('')
+        self.ignored = set()
+        if self.tracked_dirs is None or not self._run_status([]):
+            return None
+        # ignored directories were only reported by this scan to avoid watching them
+        for path in self.ignored:
+            self._unwatch_tree(path.rstrip('/'))
+        return self._fields()
+
+    def _tracked_dirs(self):
+        from subprocess import check_output, CalledProcessError, DEVNULL
+
+        try:
+            output = check_output(['git', 'ls-files', '-z'], cwd=self.root, stderr=DEVNULL)
+        except CalledProcessError:
+            return None
+        tracked_dirs = set([''])
+        for path in os.fsdecode(output).split('\0'):
+            directory = path.rpartition('/')[0]
+            while directory not in tracked_dirs:
+                tracked_dirs.add(directory)
+                directory = directory.rpartition('/')[0]
+        return tracked_dirs
+
+    def _drain(self):
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.rescan_needed = True
+                continue
+            if wd in self.git_wds:
+                # lock files come and go around every write, the write itself is what counts
+                if not name.endswith('.lock'):
+                    self.rescan_needed = True
+                continue
+            rel = self.dirs.get(wd)
+            if rel is None:
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                if self.wds.get(rel) == wd:
+                    del self.wds[rel]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if rel == '':
+                    self.rescan_needed = True
+                continue
+            if name == '.gitignore':
+                # may turn any path below into untracked or ignored, not only itself
+                self.rescan_needed = True
+                continue
+            path = rel + '/' + name if rel else name
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+            self.dirty.add(path)
+
+    def _pathspec(self, path):
+        # untracked directories are reported as a whole, so a change inside one
+        # has to be rechecked from its top-most untracked ancestor
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            directory = '/'.join(parts[:i])
+            if directory not in self.tracked_dirs:
+                return directory
+        return path
+
+    def _forget(self, pathspec):
+        prefix = pathspec + '/'
+        for path in [p for p in self.entries if p == pathspec or p.startswith(prefix)]:
+            xy = self.entries[path]
+            if xy != '!!':  # rechecks don't ask for ignored entries, keep them from the last scan
+                del self.entries[path]
+                self.counts.add(xy[0], xy[1], -1)
+
+    def _recheck(self, paths):
+        pathspecs = set(self._pathspec(path) for path in paths)
+        for pathspec in pathspecs:
+            self._forget(pathspec)
+        self._run_status(sorted(pathspecs))
+
+    def _run_status(self, pathspecs):
+        from subprocess import Popen, PIPE, DEVNULL
+
+        # GIT_OPTIONAL_LOCKS=0 keeps git from refreshing the index, which we would
+        # see as a change in the git directory and answer with a full rescan
+        env = dict(os.environ, LANG='C', GIT_OPTIONAL_LOCKS='0', GIT_LITERAL_PATHSPECS='1')
+        args = ['git', 'status', '--porcelain=v2', '--branch', '--show-stash', '-z']
+        if not pathspecs:
+            args.append('--ignored=matching')
+        po = Popen(args + ['--'] + pathspecs, env=env, stdout=PIPE, stderr=DEVNULL, cwd=self.root)
+        headers = {}
+        with po:
+            for path, xy in parse_porcelain_v2_paths(gitstatus.read_records(po.stdout, b'\0'), headers):
+                self.entries[path] = xy
+                if xy == '!!':
+                    self.ignored.add(path)
+                else:
+                    self.counts.add(xy[0], xy[1])
+        self.headers = headers
+        return po.returncode == 0
+
+
+class Journal(Tree):
+    """the paths changed in one worktree, numbered so git can ask what changed since when
+
+    Tokens are '<instance>:<sequence number>'. Tokens of another instance, e.g.
+    of a server that has since been restarted, and tokens older than the last
+    kernel queue overflow get "everything may have changed" as answer.
+    """
+
+    # answer "everything may have changed" rather than remember more paths than this
+    MAX_PATHS = 100000
+
+    def __init__(self, root):
+        Tree.__init__(self, root)
+        self.instance = 'gitstatusd-%x-%x' % (os.getpid(), time.time_ns())
+        self.seq = 0
+        self.floor = 0  # tokens before this one can't be answered
+        self.changes = {}  # relative path -> sequence number of its last change
+
+    def since(self, token):
+        """return a new token and the paths changed since token, or None if that is unknown
+
+        Directories are reported with a trailing '/' and stand for everything below them.
+        """
+        if self.inotify is None:
+            self._reset()
+            self._open()
+            self._watch_tree('')
+        else:
+            self._drain()
+        self.seq += 1
+        new_token = '%s:%d' % (self.instance, self.seq)
+        instance, _, seq = token.rpartition(':')
+        if instance != self.instance or not seq.isdigit() or int(seq) < self.floor:
+            return new_token, None
+        seq = int(seq)
+        return new_token, sorted(path for path, changed in self.changes.items() if changed > seq)
+
+    def _reset(self):
+        self.floor = self.seq + 1
+        self.changes = {}
+
+    def _drain(self):
+        changed = self.seq + 1
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self._reset()
+                continue
+            rel = self.dirs.get(wd)
+            if rel is None:
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                if self.wds.get(rel) == wd:
+                    del self.wds[rel]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if rel == '':  # the worktree itself is gone, start over on the next query
+                    self._reset()
+                    self.close()
+                    return
+                continue
+            path = rel + '/' + name if rel else name
+            if rel == '' and name == '.git':
+                continue
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                # files may have been created in there before the watch was
+                path += '/'
+            self.changes[path] = changed
+        if len(self.changes) > self.MAX_PATHS:
+            self._reset()
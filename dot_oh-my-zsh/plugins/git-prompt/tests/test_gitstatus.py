@@ -0,0 +1,72 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gitstatus
+
+
+def git(cwd, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@example.com',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@example.com')
+    subprocess.check_call(['git'] + list(args), cwd=cwd, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class RefreshTest(unittest.TestCase):
+    """GitStatus(cache=True).refresh() notices a moved or changed upstream"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['GITSTATUS_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        for name in ('GITSTATUS_CACHE', 'GITSTATUS_CACHE_TTL', 'GITSTATUS_BUDGET', 'GITSTATUS_AGGREGATE'):
+            os.environ.pop(name, None)
+        remote = os.path.join(self.tmp, 'remote.git')
+        self.work = os.path.join(self.tmp, 'work')
+        git(self.tmp, 'init', '-q', '--bare', '-b', 'master', remote)
+        git(self.tmp, 'clone', '-q', remote, self.work)
+        git(self.work, 'checkout', '-q', '-b', 'master')
+        self.commit('a')
+        git(self.work, 'push', '-q', '-u', 'origin', 'master')
+        self.commit('b')
+        # files as old as the index make git rewrite it on every status, which the
+        # fingerprint sees, so age them and let git settle the index once
+        for name in ('a', 'b'):
+            os.utime(os.path.join(self.work, name), (1000000000, 1000000000))
+        git(self.work, 'status')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def commit(self, name):
+        with open(os.path.join(self.work, name), 'w') as f:
+            f.write(name)
+        git(self.work, 'add', name)
+        git(self.work, 'commit', '-q', '-m', name)
+
+    def test_push(self):
+        repo = gitstatus.GitStatus(self.work, cache=True)
+        status = repo.refresh()
+        self.assertEqual(status.ahead, 1)
+        self.assertIs(repo.refresh(), status)  # served from the cache
+        git(self.work, 'push', '-q')
+        self.assertEqual(repo.refresh().ahead, 0)
+
+    def test_upstream_change(self):
+        git(self.work, 'push', '-q', 'origin', 'master:other')
+        repo = gitstatus.GitStatus(self.work, cache=True)
+        status = repo.refresh()
+        self.assertEqual(status.ahead, 1)
+        self.assertIs(repo.refresh(), status)
+        git(self.work, 'branch', '-q', '--set-upstream-to', 'origin/other')
+        self.assertEqual(repo.refresh().ahead, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()